@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+'''
+Microbenchmarks of the JSON hot paths: encoding of events fanned out to monitors and decoding of provider SSE data lines.
+Every installed backend (json, orjson, msgspec) is measured; `llmulink.llm.codec` uses the fastest one.
+
+Usage: python3 benchmarks/bench_codec.py [--monitors 4] [--number 100000]
+'''
+import sys
+import json
+import timeit
+import argparse
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llmulink.llm import codec  # noqa: E402
+
+
+DELTA_EVENT = {"type": "item.delta", "key": "message-3f1c9b0e-0c0a-4a55-9b8e-8f8f3c1d2e4a", "delta": " the"}
+
+ITEM_EVENT = {
+	"type": "item.updated",
+	"item": {
+		"type": "function_call",
+		"key": "fc-5b0d7d0c-1f5e-4e0e-8a53-2c9a5b1e7f10",
+		"created_at": "2026-01-01T12:00:00.000000+00:00",
+		"status": "finished",
+		"name": "ping",
+		"arguments": "{\"target\": \"example.com\"}",
+		"content": "PING example.com (93.184.216.34): 56 data bytes\n" * 20,
+		"error": False,
+	},
+}
+
+SSE_DATA = (
+	b'{"type":"response.output_text.delta","content_index":0,"delta":" the","item_id":"msg_1",'
+	b'"output_index":1,"sequence_number":42}'
+)
+
+
+def get_backends() -> dict:
+	backends = {
+		"json": (lambda obj: json.dumps(obj).encode('utf-8'), json.loads),
+	}
+
+	try:
+		import orjson
+		backends["orjson"] = (orjson.dumps, orjson.loads)
+	except ImportError:
+		pass
+
+	try:
+		import msgspec
+		backends["msgspec"] = (msgspec.json.Encoder().encode, msgspec.json.Decoder().decode)
+	except ImportError:
+		pass
+
+	return backends
+
+
+def measure(name: str, stmt, number: int) -> None:
+	elapsed = min(timeit.repeat(stmt, number=number, repeat=3))
+	print("{:<40} {:>12,.0f} ops/s".format(name, number / elapsed))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--monitors', type=int, default=4)
+	parser.add_argument('--number', type=int, default=100000)
+	args = parser.parse_args()
+
+	print("llmulink.llm.codec backend: {}".format(codec.CODEC))
+
+	for backend, (dumps, loads) in get_backends().items():
+		print()
+		measure("{} encode delta event".format(backend), lambda: dumps(DELTA_EVENT), args.number)
+		measure("{} encode item event".format(backend), lambda: dumps(ITEM_EVENT), args.number // 10)
+		measure("{} decode SSE data".format(backend), lambda: loads(SSE_DATA), args.number)
+
+	print()
+
+	def per_monitor():
+		for _ in range(args.monitors):
+			json.dumps(ITEM_EVENT)
+
+	def once():
+		event = codec.EncodedEvent(ITEM_EVENT)
+		for _ in range(args.monitors):
+			event.data
+
+	measure("fan-out to {} monitors, json per monitor".format(args.monitors), per_monitor, args.number // 10)
+	measure("fan-out to {} monitors, encoded once".format(args.monitors), once, args.number // 10)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+'''
+CPU and memory of accumulating a streamed output into an item:
+`content += delta` on a pydantic model against the chunk list of `StreamedContent`.
+
+Usage: python3 benchmarks/bench_content.py [--tokens 50000] [--reads 0]
+'''
+import sys
+import time
+import argparse
+import tracemalloc
+import os.path
+
+import pydantic
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llmulink.llm.datamodel import AssistentReasoning  # noqa: E402
+
+
+class LegacyReasoning(pydantic.BaseModel):
+	content: str
+	status: str
+
+
+def run_legacy(tokens: int, reads: int) -> None:
+	item = LegacyReasoning(content='', status='in_progress')
+	for i in range(tokens):
+		item.content += " token"
+		if reads > 0 and i % reads == 0:
+			item.content
+	item.content
+
+
+def run_chunks(tokens: int, reads: int) -> None:
+	item = AssistentReasoning(content='', status='in_progress')
+	for i in range(tokens):
+		item.append(" token")
+		if reads > 0 and i % reads == 0:
+			item.content
+	item.content
+
+
+def measure(name: str, fn, tokens: int, reads: int) -> None:
+	t0 = time.perf_counter()
+	fn(tokens, reads)
+	elapsed = time.perf_counter() - t0
+
+	tracemalloc.start()
+	fn(tokens, reads)
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	print("{:<8} {:>10.1f} ms {:>12,.0f} tokens/s  peak memory {:>8.1f} kB".format(
+		name, elapsed * 1000, tokens / elapsed, peak / 1024
+	))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--tokens', type=int, default=50000)
+	parser.add_argument('--reads', type=int, default=0, help="Read the content every N tokens (i.e. a full update), 0 only at the end")
+	args = parser.parse_args()
+
+	measure("legacy", run_legacy, args.tokens, args.reads)
+	measure("chunks", run_chunks, args.tokens, args.reads)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+'''
+Memory and CPU of conversation items: the slotted dataclasses of `llmulink.llm.datamodel`
+against the former pydantic models.
+
+Usage: python3 benchmarks/bench_datamodel.py [--conversations 10000] [--items 50] [--deltas 100000]
+'''
+import sys
+import time
+import uuid
+import typing
+import argparse
+import datetime
+import tracemalloc
+import os.path
+
+import pydantic
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llmulink.llm.datamodel import Exchange, UserMessage, AssistentMessage, FunctionCall  # noqa: E402
+
+
+def _utc_now() -> datetime.datetime:
+	return datetime.datetime.now(datetime.timezone.utc)
+
+
+class LegacyUserMessage(pydantic.BaseModel):
+	role: str
+	content: str
+	model: str
+	key: str = pydantic.Field(default_factory=lambda: "user-message-{}".format(str(uuid.uuid4())))
+	type: typing.Literal['message'] = 'message'
+	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+
+
+class LegacyAssistentMessage(pydantic.BaseModel):
+	content: str
+	status: str
+	role: str
+	key: str = pydantic.Field(default_factory=lambda: "message-{}".format(str(uuid.uuid4())))
+	type: typing.Literal['message'] = 'message'
+	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+
+	def to_dict(self) -> dict:
+		return {
+			"key": self.key,
+			"type": "message",
+			"created_at": self.created_at.isoformat(),
+			"status": self.status,
+			"role": self.role,
+			"content": self.content,
+		}
+
+
+class LegacyFunctionCall(pydantic.BaseModel):
+	call_id: str
+	name: str
+	arguments: str
+	status: str
+	content: str = ''
+	error: bool = False
+	key: str = pydantic.Field(default_factory=lambda: "fc-{}".format(str(uuid.uuid4())))
+	type: typing.Literal['function_call'] = 'function_call'
+	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+
+
+class LegacyExchange(pydantic.BaseModel):
+	items: list[LegacyUserMessage | LegacyAssistentMessage | LegacyFunctionCall] = pydantic.Field(default_factory=list)
+	completed: bool = False
+
+
+def build(conversations: int, items: int, exchange_cls, user_cls, assistant_cls, function_call_cls) -> list:
+	result = []
+	for _ in range(conversations):
+		exchanges = []
+		for i in range(items // 3):
+			exchange = exchange_cls()
+			exchange.items.append(user_cls(role='user', content="Ping the gateway", model="gpt-oss-120b"))
+			exchange.items.append(function_call_cls(call_id="call_1", name="ping", arguments='{"target": "gw"}', status='finished'))
+			exchange.items.append(assistant_cls(content="The gateway responds.", status='completed', role='assistant'))
+			exchanges.append(exchange)
+		result.append(exchanges)
+	return result
+
+
+def measure_memory(name: str, conversations: int, items: int, *classes) -> None:
+	tracemalloc.start()
+	t0 = time.perf_counter()
+	data = build(conversations, items, *classes)
+	elapsed = time.perf_counter() - t0
+	current, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del data
+	print("{:<8} {:>8.1f} MB {:>8.2f} s to build".format(name, current / 1e6, elapsed))
+
+
+def measure_deltas(name: str, deltas: int, assistant_cls, append) -> None:
+	item = assistant_cls(content='', status='in_progress', role='assistant')
+	t0 = time.perf_counter()
+	for _ in range(deltas):
+		append(item, " token")
+		{"type": "item.delta", "key": item.key, "delta": " token"}
+	item.to_dict()
+	elapsed = time.perf_counter() - t0
+	print("{:<8} {:>8.0f} ns per delta".format(name, elapsed / deltas * 1e9))
+
+
+def legacy_append(item, delta):
+	item.content += delta
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--conversations', type=int, default=10000)
+	parser.add_argument('--items', type=int, default=50)
+	parser.add_argument('--deltas', type=int, default=100000)
+	args = parser.parse_args()
+
+	print("Memory of {} conversations x {} items".format(args.conversations, args.items))
+	measure_memory("pydantic", args.conversations, args.items, LegacyExchange, LegacyUserMessage, LegacyAssistentMessage, LegacyFunctionCall)
+	measure_memory("slots", args.conversations, args.items, Exchange, UserMessage, AssistentMessage, FunctionCall)
+
+	print("CPU of streaming {} deltas".format(args.deltas))
+	measure_deltas("pydantic", args.deltas, LegacyAssistentMessage, legacy_append)
+	measure_deltas("slots", args.deltas, AssistentMessage, AssistentMessage.append)
+
+
+if __name__ == '__main__':
+	main()
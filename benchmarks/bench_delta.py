@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''
+Throughput of `item.delta` events delivered to monitors of a conversation, with and without delta coalescing.
+
+Usage: python3 benchmarks/bench_delta.py [--deltas 100000] [--monitors 4] [--window 0.025]
+'''
+import sys
+import json
+import time
+import asyncio
+import argparse
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llmulink.llm.coalescer import DeltaCoalescer  # noqa: E402
+
+
+async def run(deltas: int, monitors: int, window: float, max_bytes: int, rate: float) -> None:
+	sent = 0
+
+	async def monitor(event):
+		# Stand-in for `ws.send_json()`
+		nonlocal sent
+		json.dumps(event)
+		sent += 1
+
+	async def send_to_monitors(event):
+		async with asyncio.TaskGroup() as tg:
+			for _ in range(monitors):
+				tg.create_task(monitor(event))
+
+	coalescer = DeltaCoalescer(send_to_monitors, window=window, max_bytes=max_bytes)
+
+	t0 = time.perf_counter()
+	for i in range(deltas):
+		await coalescer.send({"type": "item.delta", "key": "message-1", "delta": "token "})
+		if rate > 0 and i % 100 == 0:
+			# Tokens arrive over time from the provider
+			await asyncio.sleep(100 / rate)
+	await coalescer.send({"type": "item.updated", "item": {"key": "message-1", "status": "completed"}})
+	elapsed = time.perf_counter() - t0
+
+	print("window={:<6} deltas/s={:>12,.0f} monitor sends={:>9,} ({:.1f} deltas per send)".format(
+		window, deltas / elapsed, sent, deltas * monitors / max(sent, 1)
+	))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--deltas', type=int, default=100000)
+	parser.add_argument('--monitors', type=int, default=4)
+	parser.add_argument('--window', type=float, default=0.025)
+	parser.add_argument('--max-bytes', type=int, default=1024)
+	parser.add_argument('--rate', type=float, default=0, help="Deltas per second produced by the provider, 0 is as fast as possible")
+	args = parser.parse_args()
+
+	for window in (0, args.window):
+		asyncio.run(run(args.deltas, args.monitors, window, args.max_bytes, args.rate))
+
+
+if __name__ == '__main__':
+	main()
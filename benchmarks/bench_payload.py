@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+'''
+CPU of building the request payload for a chat turn: the full rebuild of the history on every turn
+against the cached history fragments of `PayloadCache`.
+
+Every turn appends an exchange (a user message, a function call and an assistant message) to the conversation
+and builds the payload of the v1/responses request.
+
+Usage: python3 benchmarks/bench_payload.py [--items 10 100 1000] [--turns 20]
+'''
+import sys
+import time
+import argparse
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llmulink.llm.datamodel import Conversation, Exchange, UserMessage, AssistentMessage, FunctionCall  # noqa: E402
+from llmulink.llm.provider.v1response import LLMChatProviderV1Response  # noqa: E402
+from llmulink.llm.provider.payload import encode_json, encode_payload  # noqa: E402
+
+
+def add_exchange(conversation: Conversation) -> None:
+	exchange = Exchange()
+	conversation.add_exchange(exchange)
+	conversation.append_item(exchange, UserMessage(role='user', content="Ping the gateway and tell me the latency", model="gpt-oss-120b"))
+	conversation.append_item(exchange, FunctionCall(call_id="call_1", name="ping", arguments='{"target": "gw"}', status='finished', content="64 bytes from gw: icmp_seq=1 ttl=64 time=0.412 ms"))
+	conversation.append_item(exchange, AssistentMessage(content="The gateway responds, the latency is 0.4 ms. " * 8, status='completed', role='assistant'))
+
+
+def build_conversation(items: int) -> Conversation:
+	conversation = Conversation(conversation_id="conversation-bench", instructions="You are a helpful network assistant. " * 20)
+	for _ in range(max(1, items // 3)):
+		add_exchange(conversation)
+	return conversation
+
+
+def full_rebuild(provider, conversation: Conversation) -> bytes:
+	# The former way: the whole history is converted and serialized on every turn
+	inp = []
+	for exchange in conversation.exchanges:
+		for item in exchange.items:
+			inp.extend(provider._build_history_item(item))
+	return encode_json({
+		"model": "gpt-oss-120b",
+		"instructions": conversation.instructions,
+		"stream": True,
+		"input": inp,
+	})
+
+
+def cached(provider, conversation: Conversation) -> bytes:
+	return encode_payload({
+		"model": "gpt-oss-120b",
+		"instructions": conversation.instructions,
+		"stream": True,
+	}, {
+		"input": provider.encode_history(conversation),
+	})
+
+
+def measure(name: str, fn, items: int, turns: int) -> float:
+	# The provider is not initialized, only the payload building is used
+	provider = object.__new__(LLMChatProviderV1Response)
+	conversation = build_conversation(items)
+	fn(provider, conversation)
+
+	elapsed = 0.0
+	for _ in range(turns):
+		add_exchange(conversation)
+		t0 = time.perf_counter()
+		fn(provider, conversation)
+		elapsed += time.perf_counter() - t0
+
+	per_turn = elapsed / turns
+	print("{:<6} items={:<6} {:>10.1f} us per turn".format(name, items, per_turn * 1e6))
+	return per_turn
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 1000])
+	parser.add_argument('--turns', type=int, default=20)
+	args = parser.parse_args()
+
+	for items in args.items:
+		provider = object.__new__(LLMChatProviderV1Response)
+		a, b = build_conversation(items), build_conversation(items)
+		assert full_rebuild(provider, a) == cached(provider, b), "The payloads differ"
+
+		full = measure("full", full_rebuild, items, args.turns)
+		cache = measure("cached", cached, items, args.turns)
+		print("{:<6} {:>30.1f}x".format("gain", full / cache))
+
+
+if __name__ == '__main__':
+	main()
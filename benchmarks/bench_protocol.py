@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''
+Bandwidth and CPU per `item.delta` of the WebSocket subprotocols:
+JSON (`asab`) against MessagePack with integer item handles (`asab.msgpack`),
+each without and with permessage-deflate (the compressor keeps its context between messages).
+
+Usage: python3 benchmarks/bench_protocol.py [--deltas 100000] [--delta-size 16] [--items 4]
+'''
+import sys
+import time
+import uuid
+import zlib
+import random
+import string
+import argparse
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llmulink.llm.codec import EncodedEvent, MSGPACK  # noqa: E402
+
+
+def build_events(deltas: int, delta_size: int, items: int) -> tuple[list[dict], dict[str, int]]:
+	rnd = random.Random(1)
+	keys = ["message-{}".format(uuid.uuid4()) for _ in range(items)]
+	handles = {key: i + 1 for i, key in enumerate(keys)}
+	words = [''.join(rnd.choices(string.ascii_lowercase, k=rnd.randint(2, 9))) for _ in range(2000)]
+
+	events = []
+	for seq in range(1, deltas + 1):
+		delta = ''
+		while len(delta) < delta_size:
+			delta += ' ' + rnd.choice(words)
+		events.append({
+			"type": "item.delta",
+			"key": keys[seq % items],
+			"delta": delta,
+			"seq": seq,
+		})
+	return events, handles
+
+
+def deflate(compressor, data: bytes) -> bytes:
+	# As permessage-deflate frames a message: sync flush, without the trailing empty block
+	return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+
+def measure(name: str, events: list[dict], encode, compress: bool) -> None:
+	compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS) if compress else None
+	size = 0
+	t0 = time.perf_counter()
+	for event in events:
+		data = encode(EncodedEvent(event, event["seq"]))
+		if compressor is not None:
+			data = deflate(compressor, data)
+		size += len(data)
+	elapsed = time.perf_counter() - t0
+	print("{:<24} {:>8.1f} bytes per delta {:>8.0f} ns per delta".format(name, size / len(events), elapsed / len(events) * 1e9))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--deltas', type=int, default=100000)
+	parser.add_argument('--delta-size', type=int, default=16, help="Characters of text per delta (after coalescing)")
+	parser.add_argument('--items', type=int, default=4, help="Items streamed at the same time")
+	args = parser.parse_args()
+
+	if MSGPACK is None:
+		print("MessagePack is not available, install msgpack or msgspec")
+		sys.exit(1)
+
+	events, handles = build_events(args.deltas, args.delta_size, args.items)
+
+	print("{} deltas of {} characters, MessagePack by {}".format(args.deltas, args.delta_size, MSGPACK))
+	measure("json", events, lambda event: event.data, False)
+	measure("json+deflate", events, lambda event: event.data, True)
+	measure("msgpack", events, lambda event: event.packed(handles), False)
+	measure("msgpack+deflate", events, lambda event: event.packed(handles), True)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+'''
+Throughput of parsing a streamed SSE response: the shared `SSEParser` fed by network chunks
+against the former per-line loops of the provider adapters (decode every line to `str` and `rstrip`).
+
+Usage: python3 benchmarks/bench_sse.py [--events 50000] [--chunk 1460]
+'''
+import sys
+import time
+import argparse
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llmulink.llm.provider.sse import SSEParser  # noqa: E402
+
+
+def make_stream(events: int) -> bytes:
+	lines = []
+	for i in range(events):
+		lines.append(b'event: response.output_text.delta\n')
+		lines.append(
+			b'data: {"type":"response.output_text.delta","content_index":0,"delta":" token","item_id":"msg_1",'
+			b'"output_index":1,"sequence_number":' + str(i).encode() + b'}\n'
+		)
+		lines.append(b'\n')
+	return b''.join(lines)
+
+
+def split_lines(chunks):
+	# Stand-in for `response.content.readline()`
+	pending = b''
+	for chunk in chunks:
+		pending += chunk
+		while True:
+			p = pending.find(b'\n')
+			if p == -1:
+				break
+			yield pending[:p + 1]
+			pending = pending[p + 1:]
+
+
+def legacy_loop(chunks) -> list[bytes]:
+	result = []
+	for line in split_lines(chunks):
+		line = line.decode("utf-8").rstrip('\n\r')
+		if line == '':
+			continue
+		if line.startswith('event: '):
+			continue
+		if line.startswith('data: '):
+			result.append(line[6:].encode('utf-8'))
+	return result
+
+
+def parser_loop(chunks) -> list[bytes]:
+	result = []
+	parser = SSEParser()
+	for chunk in chunks:
+		for event in parser.feed(chunk):
+			result.append(event.data)
+	return result
+
+
+def measure(name: str, fn, chunks, size: int, events: int) -> list[bytes]:
+	best = None
+	for _ in range(3):
+		t0 = time.perf_counter()
+		result = fn(chunks)
+		elapsed = time.perf_counter() - t0
+		best = elapsed if best is None else min(best, elapsed)
+	print("{:<10} {:>12,.0f} events/s {:>8.1f} MB/s".format(name, events / best, size / best / 1e6))
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--events', type=int, default=50000)
+	parser.add_argument('--chunk', type=int, default=1460, help="Size of chunks as they arrive from the network")
+	args = parser.parse_args()
+
+	stream = make_stream(args.events)
+	chunks = [stream[i:i + args.chunk] for i in range(0, len(stream), args.chunk)]
+
+	legacy = measure("legacy", legacy_loop, chunks, len(stream), args.events)
+	parsed = measure("SSEParser", parser_loop, chunks, len(stream), args.events)
+	assert legacy == parsed, "The parsers disagree"
+
+
+if __name__ == '__main__':
+	main()
@@ -2,9 +2,10 @@ import logging
 
 import asab.api
 import asab.library
+import asab.metrics
 import asab.web.rest
 
-from .llm import LLMRouterService, LLMWebHandler
+from .llm import LLMRouterService, LLMModelCatalogService, LLMWebHandler
 from .tool import ToolService, ToolWebHandler
 
 #
@@ -47,6 +48,10 @@ class LLMMicrolinkApplication(asab.Application):
 			self.ZkContainer = asab.zookeeper.ZooKeeperContainer(self.ZooKeeperService, 'zookeeper')
 			self.ASABApiService.initialize_zookeeper(self.ZkContainer)
 
+		# Initialize MetricsService
+		self.add_module(asab.metrics.Module)
+		self.MetricsService = self.get_service("asab.MetricsService")
+
 		# Initialize the Tenant service
 		self.TenantService = asab.web.tenant.TenantService(self)
 
@@ -55,6 +60,7 @@ class LLMMicrolinkApplication(asab.Application):
 
 		# Initialize LLMConversationRouterService
 		self.LLMRouterService = LLMRouterService(self)
+		self.LLMModelCatalogService = LLMModelCatalogService(self)
 		self.LLMWebHandler = LLMWebHandler(self)
 
 		# Initialize ToolService
@@ -1,9 +1,11 @@
 from .svc_router import LLMRouterService
+from .svc_catalog import LLMModelCatalogService
 from .handler_web import LLMWebHandler
 from .datamodel import FunctionCallTool
 
 __all__ = [
 	"LLMRouterService",
+	"LLMModelCatalogService",
 	"LLMWebHandler",
 	"FunctionCallTool",
 ]
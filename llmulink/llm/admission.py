@@ -0,0 +1,274 @@
+import time
+import asyncio
+import logging
+import collections
+
+import asab
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class AdmissionTicket:
+	'''
+	A request waiting in the admission queue for a slot at one of the providers.
+	'''
+
+	__slots__ = ('Conversation', 'Tenant', 'Priority', 'Providers', 'Future', 'EnqueuedAt')
+
+	def __init__(self, conversation, tenant, priority, providers):
+		self.Conversation = conversation
+		self.Tenant = tenant
+		self.Priority = priority
+		self.Providers = providers
+		self.Future = asyncio.get_running_loop().create_future()
+		self.EnqueuedAt = time.monotonic()
+
+
+class TenantQueue:
+
+	__slots__ = ('Tickets', 'Deficit')
+
+	def __init__(self):
+		self.Tickets = collections.deque()
+		self.Deficit = 0
+
+
+class AdmissionQueue:
+	'''
+	Fair admission of chat requests to provider slots.
+
+	Requests are grouped by priority and served strictly from the highest priority that can be served.
+	Within a priority, tenants are served by deficit round robin, so that a heavy tenant cannot starve the others.
+	A request is admitted once any provider that serves its model has a free slot.
+	'''
+
+	def __init__(self, router, priorities: dict[str, int] | None = None, quantum: int = 1):
+		self.Router = router
+		self.Priorities = priorities or {}
+		self.Quantum = quantum
+
+		# Priority -> tenant -> queue of tickets; the order of tenants is the round robin order
+		self.Classes = dict[int, collections.OrderedDict[str, TenantQueue]]()
+		self.Depth = 0
+
+		self.DepthGauge = router.MetricsService.create_gauge(
+			"llm_admission_queue",
+			init_values={"depth": 0, "oldest_wait": 0.0},
+		)
+		self.WaitCounter = router.MetricsService.create_counter(
+			"llm_admission",
+			init_values={"admitted": 0, "wait_seconds": 0.0},
+		)
+		# The wait of the oldest request grows while nothing happens in the queue, it is refreshed when metrics are collected
+		router.App.PubSub.subscribe("Metrics.flush!", self._on_metrics_flush)
+
+
+	def register_provider(self, provider) -> None:
+		provider.Limiter.OnAvailable = self.dispatch
+
+
+	async def admit(self, conversation, providers: list, notify: bool = True):
+		'''
+		Wait for a slot at one of the providers.
+		Returns the provider with the slot acquired, the caller must release it by `provider.Limiter.release()`.
+		If `notify` is True, the conversation is informed about its position in the queue.
+		'''
+		tenant = conversation.tenant or ''
+		ticket = AdmissionTicket(conversation, tenant, self.Priorities.get(tenant, 0), providers)
+		self._enqueue(ticket)
+		self.dispatch()
+
+		notified = False
+		try:
+			while not ticket.Future.done():
+				if notify:
+					await self.send_position(ticket)
+					notified = True
+				try:
+					await asyncio.wait_for(asyncio.shield(ticket.Future), timeout=1.0)
+				except asyncio.TimeoutError:
+					pass
+
+		except asyncio.CancelledError:
+			if ticket.Future.done() and not ticket.Future.cancelled():
+				ticket.Future.result().Limiter.release()
+			else:
+				ticket.Future.cancel()
+				self._remove(ticket)
+			raise
+
+		wait_time = time.monotonic() - ticket.EnqueuedAt
+		self.WaitCounter.add("admitted", 1)
+		self.WaitCounter.add("wait_seconds", wait_time)
+
+		if notified:
+			# The conversation has been told that it is waiting
+			await self.Router.send_update(conversation, {
+				"type": "queue.updated",
+				"position": 0,
+				"eta": 0.0,
+			})
+
+		return ticket.Future.result()
+
+
+	def dispatch(self) -> None:
+		'''
+		Hand over free provider slots to waiting requests.
+		'''
+		if self.Depth == 0:
+			return
+
+		for priority in sorted(self.Classes.keys(), reverse=True):
+			tenants = self.Classes[priority]
+
+			# Deficit round robin with a unit cost of a request
+			idle_rounds = 0
+			while len(tenants) > 0 and idle_rounds < len(tenants):
+				tenant, tqueue = next(iter(tenants.items()))
+				tqueue.Deficit = min(tqueue.Deficit + self.Quantum, self.Quantum)
+
+				admitted = 0
+				while tqueue.Deficit > 0 and self._admit_one(tqueue):
+					tqueue.Deficit -= 1
+					admitted += 1
+
+				if len(tqueue.Tickets) == 0:
+					del tenants[tenant]
+				else:
+					tenants.move_to_end(tenant)
+
+				idle_rounds = 0 if admitted > 0 else idle_rounds + 1
+
+			if len(tenants) == 0:
+				del self.Classes[priority]
+
+		self._update_gauge()
+
+
+	def _admit_one(self, tqueue: TenantQueue) -> bool:
+		for ticket in tqueue.Tickets:
+			candidates = [
+				provider for provider in ticket.Providers
+				if provider.Health.available and provider.Limiter.available
+			]
+			if len(candidates) == 0:
+				continue
+
+			provider = self.Router.SelectProvider(candidates)
+			if not provider.Limiter.try_acquire():
+				continue
+
+			provider.Health.on_admit()
+			tqueue.Tickets.remove(ticket)
+			self.Depth -= 1
+			_count_queued(ticket, -1)
+			ticket.Future.set_result(provider)
+			return True
+
+		return False
+
+
+	def _enqueue(self, ticket: AdmissionTicket) -> None:
+		tenants = self.Classes.setdefault(ticket.Priority, collections.OrderedDict())
+		tqueue = tenants.get(ticket.Tenant)
+		if tqueue is None:
+			tqueue = tenants[ticket.Tenant] = TenantQueue()
+		tqueue.Tickets.append(ticket)
+		self.Depth += 1
+		_count_queued(ticket, 1)
+		self._update_gauge()
+
+
+	def _remove(self, ticket: AdmissionTicket) -> None:
+		tenants = self.Classes.get(ticket.Priority)
+		if tenants is None:
+			return
+		tqueue = tenants.get(ticket.Tenant)
+		if tqueue is None or ticket not in tqueue.Tickets:
+			return
+
+		tqueue.Tickets.remove(ticket)
+		self.Depth -= 1
+		_count_queued(ticket, -1)
+		if len(tqueue.Tickets) == 0:
+			del tenants[ticket.Tenant]
+			if len(tenants) == 0:
+				del self.Classes[ticket.Priority]
+		self._update_gauge()
+
+
+	def get_position(self, ticket: AdmissionTicket) -> int:
+		'''
+		Estimate the position of the ticket in the queue.
+		Tickets of higher priorities are ahead, tenants of the same priority take turns.
+		'''
+		position = 1
+		for priority, tenants in self.Classes.items():
+			if priority > ticket.Priority:
+				position += sum(len(tqueue.Tickets) for tqueue in tenants.values())
+
+			elif priority == ticket.Priority:
+				tqueue = tenants.get(ticket.Tenant)
+				if tqueue is None or ticket not in tqueue.Tickets:
+					continue
+				index = tqueue.Tickets.index(ticket)
+				# Every other tenant gets its turn for each ticket ahead of us in our own queue
+				position += index + sum(min(len(other.Tickets), index + 1) for tenant, other in tenants.items() if tenant != ticket.Tenant)
+
+		return position
+
+
+	def get_eta(self, ticket: AdmissionTicket, position: int) -> float | None:
+		'''
+		Estimate the time until the ticket is admitted, in seconds.
+		'''
+		slots = sum(int(provider.Limiter.Limit) for provider in ticket.Providers)
+		durations = [provider.Stats.Duration for provider in ticket.Providers if provider.Stats.Duration is not None]
+		if slots == 0 or len(durations) == 0:
+			return None
+		return position * (sum(durations) / len(durations)) / slots
+
+
+	async def send_position(self, ticket: AdmissionTicket) -> None:
+		position = self.get_position(ticket)
+		await self.Router.send_update(ticket.Conversation, {
+			"type": "queue.updated",
+			"position": position,
+			"eta": self.get_eta(ticket, position),
+		})
+
+
+	def _on_metrics_flush(self, message_type) -> None:
+		self._update_gauge()
+
+
+	def _update_gauge(self) -> None:
+		self.DepthGauge.set("depth", self.Depth)
+
+		oldest = None
+		for tenants in self.Classes.values():
+			for tqueue in tenants.values():
+				if len(tqueue.Tickets) > 0 and (oldest is None or tqueue.Tickets[0].EnqueuedAt < oldest):
+					oldest = tqueue.Tickets[0].EnqueuedAt
+		self.DepthGauge.set("oldest_wait", 0.0 if oldest is None else time.monotonic() - oldest)
+
+
+def _count_queued(ticket: AdmissionTicket, delta: int) -> None:
+	# Queued requests are not bound to a provider yet, they count to the load of every provider that may serve them
+	for provider in ticket.Providers:
+		provider.Stats.Queued += delta
+
+
+def load_priorities() -> dict[str, int]:
+	'''
+	Load tenant priorities from the `[llm:priorities]` configuration section, i.e. `mytenant=10`.
+	Tenants that are not listed have the priority 0.
+	'''
+	if "llm:priorities" not in asab.Config.sections():
+		return {}
+	return {tenant: int(priority) for tenant, priority in asab.Config["llm:priorities"].items()}
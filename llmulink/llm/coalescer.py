@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class DeltaCoalescer:
+	'''
+	Batch `item.delta` events of a conversation before they are sent to monitors.
+
+	Deltas are held for up to `window` seconds or until `max_bytes` of text is buffered, whichever comes first,
+	and consecutive deltas of the same item are merged into one event.
+	Any other event (i.e. a change of the item status) flushes the buffered deltas first, so the order of events is kept.
+	'''
+
+	__slots__ = ('Send', 'Window', 'MaxBytes', 'Deltas', 'Bytes', 'Timer', 'Lock')
+
+	def __init__(self, send, window: float, max_bytes: int):
+		self.Send = send  # Coroutine function that delivers an event to monitors
+		self.Window = window
+		self.MaxBytes = max_bytes
+
+		self.Deltas = dict[str, list[str]]()  # Item key -> buffered deltas, in the order of the first delta
+		self.Bytes = 0
+		self.Timer = None
+		self.Lock = asyncio.Lock()  # Keeps the order of events sent from concurrent tasks
+
+
+	async def send(self, event: dict) -> None:
+		if event["type"] == "item.delta" and self.Window > 0:
+			delta = event["delta"]
+			self.Deltas.setdefault(event["key"], []).append(delta)
+			# Bytes of the UTF-8 encoded text, `isascii()` is cheap and most of the text is ASCII
+			self.Bytes += len(delta) if delta.isascii() else len(delta.encode('utf-8'))
+			if self.Bytes < self.MaxBytes:
+				if self.Timer is None:
+					self.Timer = asyncio.get_running_loop().call_later(self.Window, self._on_timer)
+				return
+			event = None
+
+		events = self._take()
+		if event is not None:
+			events.append(event)
+
+		async with self.Lock:
+			for event in events:
+				await self.Send(event)
+
+
+	async def flush(self) -> None:
+		events = self._take()
+		if len(events) == 0:
+			return
+		async with self.Lock:
+			for event in events:
+				await self.Send(event)
+
+
+	def _take(self) -> list[dict]:
+		if self.Timer is not None:
+			self.Timer.cancel()
+			self.Timer = None
+
+		if len(self.Deltas) == 0:
+			return []
+
+		events = [
+			{
+				"type": "item.delta",
+				"key": key,
+				"delta": deltas[0] if len(deltas) == 1 else ''.join(deltas),
+			}
+			for key, deltas in self.Deltas.items()
+		]
+		self.Deltas = {}
+		self.Bytes = 0
+		return events
+
+
+	def _on_timer(self) -> None:
+		self.Timer = None
+		asyncio.create_task(self._flush_safe())
+
+
+	async def _flush_safe(self) -> None:
+		try:
+			await self.flush()
+		except Exception:
+			L.exception("Error flushing deltas to monitors")
@@ -0,0 +1,154 @@
+'''
+JSON codec used on hot paths: events sent to clients, request payloads and SSE responses of providers.
+
+The fastest available backend is used: `orjson`, `msgspec` or the standard `json` module.
+All backends produce compact JSON encoded to UTF-8 bytes.
+
+MessagePack, for the compact WebSocket subprotocol, is available if `msgpack` or `msgspec` is installed.
+'''
+
+import json
+
+try:
+	import orjson
+
+	CODEC = 'orjson'
+
+	def dumps(obj) -> bytes:
+		return orjson.dumps(obj)
+
+	def loads(data: bytes | str):
+		return orjson.loads(data)
+
+except ImportError:
+	try:
+		import msgspec
+
+		CODEC = 'msgspec'
+		_encoder = msgspec.json.Encoder()
+		_decoder = msgspec.json.Decoder()
+
+		def dumps(obj) -> bytes:
+			return _encoder.encode(obj)
+
+		def loads(data: bytes | str):
+			try:
+				return _decoder.decode(data)
+			except msgspec.DecodeError as e:
+				# Same exception as other backends raise
+				raise json.JSONDecodeError(str(e), data if isinstance(data, str) else data.decode('utf-8', 'replace'), 0) from None
+
+	except ImportError:
+		CODEC = 'json'
+		_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+		def dumps(obj) -> bytes:
+			return _encoder.encode(obj).encode('utf-8')
+
+		def loads(data: bytes | str):
+			return json.loads(data)
+
+
+# Raised by `loads()` on invalid JSON, orjson raises its subclass
+JSONDecodeError = json.JSONDecodeError
+
+
+try:
+	import msgpack
+
+	MSGPACK = 'msgpack'
+
+	def packb(obj) -> bytes:
+		return msgpack.packb(obj)
+
+	def unpackb(data: bytes):
+		return msgpack.unpackb(data)
+
+except ImportError:
+	try:
+		import msgspec.msgpack
+
+		MSGPACK = 'msgspec'
+		_packer = msgspec.msgpack.Encoder()
+		_unpacker = msgspec.msgpack.Decoder()
+
+		def packb(obj) -> bytes:
+			return _packer.encode(obj)
+
+		def unpackb(data: bytes):
+			return _unpacker.decode(data)
+
+	except ImportError:
+		# The compact subprotocol is not offered
+		MSGPACK = None
+		packb = None
+		unpackb = None
+
+
+def compact(event: dict, handles: dict[str, int]) -> dict:
+	'''
+	The event for the compact subprotocol, items are referred to by integer handles instead of their keys.
+
+	Items in `item.appended` and in full updates carry both the key and the handle, so that the client learns the handle,
+	other events carry only the handle (keys without a handle are kept).
+	'''
+	match event["type"]:
+
+		case "item.delta":
+			handle = handles.get(event["key"])
+			if handle is None:
+				return event
+			event = dict(event, handle=handle)
+			del event["key"]
+			return event
+
+		case "item.appended":
+			item = event["item"]
+			return dict(event, item=dict(item, handle=handles.get(item["key"])))
+
+		case "item.updated":
+			item = event["item"]
+			handle = handles.get(item["key"])
+			if handle is None:
+				return event
+			item = dict(item, handle=handle)
+			del item["key"]
+			return dict(event, item=item)
+
+		case "update.full" | "update.page":
+			return dict(event, items=[dict(item, handle=handles.get(item["key"])) for item in event["items"]])
+
+	return event
+
+
+class EncodedEvent:
+	'''
+	An event for monitors of a conversation, encoded once and shared by all monitors.
+	'''
+
+	__slots__ = ('Event', 'Seq', '_Data', '_Packed')
+
+	def __init__(self, event: dict, seq: int | None = None):
+		self.Event = event
+		self.Seq = seq  # Sequence number of the event (or of the state in a full update), None if not sequenced
+		self._Data = None
+		self._Packed = None
+
+	@property
+	def data(self) -> bytes:
+		'''
+		The event as UTF-8 encoded JSON, the payload of a WebSocket text message.
+		'''
+		if self._Data is None:
+			self._Data = dumps(self.Event)
+		return self._Data
+
+
+	def packed(self, handles: dict[str, int]) -> bytes:
+		'''
+		The event in the compact form, as MessagePack for a WebSocket binary message.
+		The `handles` are item handles of the conversation of the event, see `Conversation.item_handles`.
+		'''
+		if self._Packed is None:
+			self._Packed = packb(compact(self.Event, handles))
+		return self._Packed
@@ -0,0 +1,325 @@
+import logging
+import dataclasses
+
+import asab
+
+from .datamodel import Conversation, Exchange, UserMessage, AssistentMessage, FunctionCall
+from .hedging import HedgedChatRequest
+from .provider.payload import is_final
+from .provider.provider_abc import LLMProviderError
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+ELIDED_OUTPUT = "[Output of this function call was removed to save space.]"
+
+SUMMARY_INSTRUCTIONS = (
+	"Summarize the following conversation between a user and an AI assistant. "
+	"Keep the facts, decisions, findings and open questions that may be needed to continue the conversation. "
+	"Reply only with the summary."
+)
+
+SUMMARY_PREFIX = "Summary of the earlier part of this conversation:\n\n"
+
+
+class ContextWindow:
+	'''
+	The part of the conversation history that is sent to the model.
+
+	The window is changed only when the history doesn't fit the token budget of the model,
+	so that the pre-serialized payload and the prompt cache of the provider stay valid between turns.
+	'''
+
+	__slots__ = ('Start', 'Elided', 'Summary', 'SummaryItem', 'Tokens')
+
+	def __init__(self):
+		self.Start = 0  # Index of the first exchange in the window
+		self.Elided = set()  # Keys of function calls which output is not sent
+		self.Summary = None  # Summary of the exchanges before `Start`
+		self.SummaryItem = None  # The summary, as an item of the history
+		self.Tokens = dict[str, int]()  # Item key -> estimated tokens, only for items that will not change anymore
+
+
+	def get_item(self, item):
+		'''
+		Get the item as it is sent to the model.
+		'''
+		if item.key in self.Elided:
+			return dataclasses.replace(item, content=ELIDED_OUTPUT)
+		return item
+
+
+class ByteTokenizer:
+	'''
+	Estimate the number of tokens from the length of the UTF-8 encoded text.
+	'''
+
+	def __init__(self, bytes_per_token: float = 4.0):
+		self.BytesPerToken = bytes_per_token
+
+	def count(self, text: str) -> int:
+		return int(len(text.encode('utf-8')) / self.BytesPerToken) + 1
+
+
+class TiktokenTokenizer:
+	'''
+	Count tokens by a local `tiktoken` encoding, i.e. `cl100k_base`.
+	'''
+
+	def __init__(self, encoding: str):
+		import tiktoken
+		self.Encoding = tiktoken.get_encoding(encoding)
+
+	def count(self, text: str) -> int:
+		return len(self.Encoding.encode(text, disallowed_special=()))
+
+
+def create_tokenizer(spec: str):
+	'''
+	Create the tokenizer from the configuration, i.e. `bytes`, `bytes:3.5` or `tiktoken:cl100k_base`.
+	'''
+	name, _, arg = spec.partition(':')
+	match name:
+		case 'bytes':
+			return ByteTokenizer(float(arg) if arg else 4.0)
+		case 'tiktoken':
+			try:
+				return TiktokenTokenizer(arg or 'cl100k_base')
+			except ImportError:
+				L.warning("The tiktoken package is not installed, falling back to the byte heuristic")
+				return ByteTokenizer()
+		case _:
+			raise ValueError("Unknown tokenizer '{}'".format(spec))
+
+
+class ContextManager:
+	'''
+	Keep the conversation history within the token budget of the model.
+
+	Budgets are configured per model in the `[llm:context]` section (`model=tokens`),
+	the `context_budget` option of the `[llm]` section applies to other models, 0 means unbounded.
+	When the budget is exceeded, the history is reduced to `context_target` of the budget by the policy:
+
+	drop_oldest: the oldest exchanges are not sent.
+	elide_tool_outputs: outputs of the oldest function calls are replaced by a placeholder, then the oldest exchanges are dropped.
+	summarize: the oldest exchanges are replaced by their summary, written by the model itself.
+
+	The current turn, from the most recent user message on (with function calls of the agentic loop), is always sent as a whole.
+	'''
+
+	def __init__(self, router):
+		self.Router = router
+
+		self.DefaultBudget = asab.Config.getint("llm", "context_budget")
+		self.Budgets = dict[str, int]()
+		if "llm:context" in asab.Config.sections():
+			self.Budgets = {model: int(budget) for model, budget in asab.Config["llm:context"].items()}
+
+		self.Target = asab.Config.getfloat("llm", "context_target")
+		self.Policy = asab.Config.get("llm", "context_policy")
+		if self.Policy not in ('drop_oldest', 'elide_tool_outputs', 'summarize'):
+			raise ValueError("Unknown context policy '{}'".format(self.Policy))
+
+		self.Tokenizer = create_tokenizer(asab.Config.get("llm", "context_tokenizer"))
+
+		self.Counter = router.MetricsService.create_counter(
+			"llm_context",
+			init_values={"dropped": 0, "elided": 0, "summarized": 0},
+		)
+
+
+	def get_budget(self, model: str) -> int:
+		return self.Budgets.get(model, self.DefaultBudget)
+
+
+	def get_window(self, conversation: Conversation) -> ContextWindow:
+		window = conversation.context_window
+		if window is None:
+			window = conversation.context_window = ContextWindow()
+		return window
+
+
+	def estimate_item(self, window: ContextWindow, item) -> int:
+		tokens = window.Tokens.get(item.key)
+		if tokens is not None:
+			return tokens
+
+		item = window.get_item(item)
+		tokens = 4  # Overhead of the entry
+		match item:
+			case FunctionCall():
+				tokens += self.Tokenizer.count(item.name) + self.Tokenizer.count(item.arguments) + self.Tokenizer.count(item.content)
+			case _:
+				tokens += self.Tokenizer.count(item.content)
+
+		if is_final(item):
+			window.Tokens[item.key] = tokens
+		return tokens
+
+
+	def estimate(self, conversation: Conversation, window: ContextWindow) -> int:
+		'''
+		Estimate the number of prompt tokens of the conversation as it would be sent now.
+		'''
+		tokens = self.Tokenizer.count(conversation.instructions)
+		for tool in conversation.tools:
+			tokens += self.Tokenizer.count(tool.name) + self.Tokenizer.count(tool.description) + self.Tokenizer.count(str(tool.parameters))
+		if window.SummaryItem is not None:
+			tokens += self.estimate_item(window, window.SummaryItem)
+		for exchange in conversation.exchanges[window.Start:]:
+			for item in exchange.items:
+				tokens += self.estimate_item(window, item)
+		return tokens
+
+
+	async def fit(self, conversation: Conversation, model: str, providers: list) -> None:
+		'''
+		Adjust the context window of the conversation to the budget of the model.
+		'''
+		budget = self.get_budget(model)
+		if budget <= 0:
+			return
+
+		window = self.get_window(conversation)
+		tokens = self.estimate(conversation, window)
+		if tokens <= budget:
+			return
+
+		target = int(budget * self.Target)
+		start, elided = window.Start, len(window.Elided)
+
+		if self.Policy == 'elide_tool_outputs':
+			tokens = self._elide(conversation, window, tokens, target)
+
+		if tokens > target:
+			dropped = self._drop(conversation, window, tokens, target)
+			if self.Policy == 'summarize' and len(dropped) > 0:
+				await self._summarize(conversation, window, dropped, model, providers)
+
+		if window.Start == start and len(window.Elided) == elided:
+			L.warning("Conversation doesn't fit the context budget", struct_data={"conversation_id": conversation.conversation_id, "model": model, "budget": budget})
+			return
+
+		L.log(asab.LOG_NOTICE, "Context window of the conversation reduced", struct_data={
+			"conversation_id": conversation.conversation_id,
+			"model": model,
+			"budget": budget,
+			"tokens": self.estimate(conversation, window),
+			"start": window.Start,
+			"elided": len(window.Elided),
+		})
+
+		# The history is rewritten, the pre-serialized payload and the responses stored at providers are no longer valid
+		conversation.payload_cache.clear()
+		for exchange in conversation.exchanges:
+			exchange.response_id = None
+
+
+	def _elide(self, conversation: Conversation, window: ContextWindow, tokens: int, target: int) -> int:
+		for exchange in conversation.exchanges[window.Start:_current_turn(conversation.exchanges)]:
+			for item in exchange.items:
+				if tokens <= target:
+					return tokens
+				if not isinstance(item, FunctionCall) or item.key in window.Elided or not is_final(item):
+					continue
+
+				before = self.estimate_item(window, item)
+				window.Elided.add(item.key)
+				window.Tokens.pop(item.key, None)
+				tokens -= before - self.estimate_item(window, item)
+				self.Counter.add("elided", 1)
+
+		return tokens
+
+
+	def _drop(self, conversation: Conversation, window: ContextWindow, tokens: int, target: int) -> list[Exchange]:
+		'''
+		Move the start of the window forward by whole exchanges.
+		The window starts with a user message, exchanges that continue an agentic loop are dropped together with it.
+		'''
+		exchanges = conversation.exchanges
+		current = _current_turn(exchanges)
+		start = window.Start
+
+		while tokens > target and start < current:
+			tokens -= sum(self.estimate_item(window, item) for item in exchanges[start].items)
+			start += 1
+			while start < current and not _starts_with_user_message(exchanges[start]):
+				tokens -= sum(self.estimate_item(window, item) for item in exchanges[start].items)
+				start += 1
+
+		dropped = exchanges[window.Start:start]
+		for exchange in dropped:
+			for item in exchange.items:
+				window.Elided.discard(item.key)
+				window.Tokens.pop(item.key, None)
+
+		window.Start = start
+		self.Counter.add("dropped", len(dropped))
+		return dropped
+
+
+	async def _summarize(self, conversation: Conversation, window: ContextWindow, dropped: list[Exchange], model: str, providers: list) -> None:
+		'''
+		Summarize the dropped exchanges, together with the previous summary, by the model of the conversation.
+		If the summary fails, the exchanges are just dropped.
+		'''
+		lines = []
+		if window.Summary is not None:
+			lines.append(window.Summary)
+		for exchange in dropped:
+			for item in exchange.items:
+				match item:
+					case UserMessage():
+						lines.append("User: " + item.content)
+					case AssistentMessage():
+						lines.append("Assistant: " + item.content)
+					case FunctionCall():
+						lines.append("Function call {}({}): {}".format(item.name, item.arguments, item.content))
+
+		# The summary conversation is private, it has no monitors and no tools
+		summary_conversation = Conversation(
+			conversation_id=conversation.conversation_id + "-summary",
+			tenant=conversation.tenant,
+			instructions=SUMMARY_INSTRUCTIONS,
+		)
+		summary_exchange = Exchange()
+		summary_conversation.add_exchange(summary_exchange)
+		summary_conversation.append_item(summary_exchange, UserMessage(role='user', content="\n\n".join(lines), model=model))
+
+		request = HedgedChatRequest(
+			self.Router, summary_conversation, summary_exchange, providers,
+			hedge_after=self.Router.HedgeAfter,
+			hedge_max=self.Router.HedgeMax,
+		)
+		try:
+			await request.run()
+		except LLMProviderError as e:
+			L.warning("Summary of the conversation failed", struct_data={"conversation_id": conversation.conversation_id, "error": str(e)})
+			return
+
+		message = summary_exchange.get_last_item('message')
+		if not isinstance(message, AssistentMessage) or len(message.content) == 0:
+			return
+
+		window.Summary = message.content
+		window.SummaryItem = UserMessage(role='user', content=SUMMARY_PREFIX + message.content, model=model)
+		self.Counter.add("summarized", 1)
+
+
+def _current_turn(exchanges: list[Exchange]) -> int:
+	'''
+	Index of the exchange that starts the current turn, the last one that starts with a user message.
+	Exchanges that follow it continue the agentic loop, i.e. the one that awaits the response to function calls.
+	'''
+	for i in range(len(exchanges) - 1, -1, -1):
+		if _starts_with_user_message(exchanges[i]):
+			return i
+	return max(len(exchanges) - 1, 0)
+
+
+def _starts_with_user_message(exchange: Exchange) -> bool:
+	return len(exchange.items) > 0 and isinstance(exchange.items[0], UserMessage)
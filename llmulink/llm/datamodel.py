@@ -1,7 +1,7 @@
-from asyncio import Task
 import uuid
 import typing
 import datetime
+import dataclasses
 
 import pydantic
 
@@ -13,65 +13,125 @@ def _utc_now() -> datetime.datetime:
 	return datetime.datetime.now(datetime.timezone.utc)
 
 
-class AssistentReasoning(pydantic.BaseModel):
+def _utc_now_iso() -> str:
+	"""Current UTC time as an ISO string, items keep it formatted for `to_dict()`."""
+	return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+# Items of the conversation are slotted dataclasses, they are created and mutated on the streaming hot path.
+# Pydantic is used only at the API boundaries (i.e. the Conversation and tool declarations).
+
+
+# Deltas of a streamed item are joined into a block once there is this many of them
+STREAMED_BLOCK_CHUNKS = 256
+
+
+@dataclasses.dataclass(slots=True, eq=False)
+class StreamedContent:
+	"""
+	Content of an item that is streamed from the LLM token by token.
+
+	Deltas are appended to a list of chunks and joined only when the `content` is read,
+	so that a long output is not copied on every token.
+	Every `STREAMED_BLOCK_CHUNKS` deltas are joined into a block, so that the list doesn't hold an object per token;
+	each character is copied once into its block and once more when the content is read.
+	"""
+	chunks: list[str]
+	blocks: int  # Number of leading chunks that are joined blocks, the rest are deltas
+
+	@property
+	def content(self) -> str:
+		chunks = self.chunks
+		if len(chunks) != 1:
+			# Materialize, the joined string replaces the chunks
+			chunks[:] = [''.join(chunks)]
+			self.blocks = 1
+		return chunks[0]
+
+	def append(self, delta: str) -> None:
+		chunks = self.chunks
+		chunks.append(delta)
+		if len(chunks) - self.blocks >= STREAMED_BLOCK_CHUNKS:
+			chunks[self.blocks:] = [''.join(chunks[self.blocks:])]
+			self.blocks += 1
+
+
+@dataclasses.dataclass(slots=True, eq=False, init=False)
+class AssistentReasoning(StreamedContent):
 	"""Reasoning block from the LLM response."""
-	content: str
 	status: str
-	key: str = pydantic.Field(default_factory=lambda: "reasoning-{}".format(str(uuid.uuid4())))
-	type: typing.Literal['reasoning'] = 'reasoning'
-	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+	key: str
+	created_at: str
+	type: typing.ClassVar[str] = 'reasoning'
+
+	def __init__(self, content: str, status: str):
+		self.chunks = [content]
+		self.blocks = 1
+		self.status = status
+		self.key = "reasoning-{}".format(str(uuid.uuid4()))
+		self.created_at = _utc_now_iso()
 
 	def to_dict(self) -> dict:
 		return {
 			"key": self.key,
 			"type": "reasoning",
-			"created_at": self.created_at.isoformat(),
+			"created_at": self.created_at,
 			"content": self.content,
 			"status": self.status,
 		}
 
 
-class AssistentMessage(pydantic.BaseModel):
+@dataclasses.dataclass(slots=True, eq=False, init=False)
+class AssistentMessage(StreamedContent):
 	"""Message block from the LLM response."""
-	content: str
 	status: str
 	role: str
-	key: str = pydantic.Field(default_factory=lambda: "message-{}".format(str(uuid.uuid4())))
-	type: typing.Literal['message'] = 'message'
-	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+	key: str
+	created_at: str
+	type: typing.ClassVar[str] = 'message'
+
+	def __init__(self, content: str, status: str, role: str):
+		self.chunks = [content]
+		self.blocks = 1
+		self.status = status
+		self.role = role
+		self.key = "message-{}".format(str(uuid.uuid4()))
+		self.created_at = _utc_now_iso()
 
 	def to_dict(self) -> dict:
 		return {
 			"key": self.key,
 			"type": "message",
-			"created_at": self.created_at.isoformat(),
+			"created_at": self.created_at,
 			"status": self.status,
 			"role": self.role,
 			"content": self.content,
 		}
 
 
-class UserMessage(pydantic.BaseModel):
+@dataclasses.dataclass(slots=True, eq=False)
+class UserMessage:
 	"""User message (item) in a conversation."""
 	role: str
 	content: str
 	model: str
-	key: str = pydantic.Field(default_factory=lambda: "user-message-{}".format(str(uuid.uuid4())))
-	type: typing.Literal['message'] = 'message'
-	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+	key: str = dataclasses.field(default_factory=lambda: "user-message-{}".format(str(uuid.uuid4())))
+	created_at: str = dataclasses.field(default_factory=_utc_now_iso)
+	type: typing.ClassVar[str] = 'message'
 
 	def to_dict(self) -> dict:
 		return {
 			"key": self.key,
 			"type": "message",
-			"created_at": self.created_at.isoformat(),
+			"created_at": self.created_at,
 			"role": self.role,
 			"content": self.content,
 			"model": self.model,
 		}
 
 
-class FunctionCall(pydantic.BaseModel):
+@dataclasses.dataclass(slots=True, eq=False)
+class FunctionCall:
 	"""Function call block from the LLM response."""
 	call_id: str
 	name: str
@@ -79,15 +139,15 @@ class FunctionCall(pydantic.BaseModel):
 	status: str
 	content: str = ''
 	error: bool = False
-	key: str = pydantic.Field(default_factory=lambda: "fc-{}".format(str(uuid.uuid4())))
-	type: typing.Literal['function_call'] = 'function_call'
-	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+	key: str = dataclasses.field(default_factory=lambda: "fc-{}".format(str(uuid.uuid4())))
+	created_at: str = dataclasses.field(default_factory=_utc_now_iso)
+	type: typing.ClassVar[str] = 'function_call'
 
 	def to_dict(self) -> dict:
 		return {
 			"type": "function_call",
 			"key": self.key,
-			"created_at": self.created_at.isoformat(),
+			"created_at": self.created_at,
 			"status": self.status,
 			"name": self.name,
 			"arguments": self.arguments,
@@ -96,17 +156,23 @@ class FunctionCall(pydantic.BaseModel):
 		}
 
 
-class ChatToolResult(pydantic.BaseModel):
+@dataclasses.dataclass(slots=True, eq=False)
+class ChatToolResult:
 	"""Result of a tool/function execution."""
 	call_id: str
-	type: typing.Literal['function_call_output'] = 'function_call_output'
-	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
+	created_at: str = dataclasses.field(default_factory=_utc_now_iso)
+	type: typing.ClassVar[str] = 'function_call_output'
 
 
-class Exchange(pydantic.BaseModel):
+@dataclasses.dataclass(slots=True, eq=False)
+class Exchange:
 	"""An exchange between the user and the LLM."""
-	items: list[UserMessage|AssistentReasoning|AssistentMessage|FunctionCall] = pydantic.Field(default_factory=list)
+	items: list[UserMessage|AssistentReasoning|AssistentMessage|FunctionCall] = dataclasses.field(default_factory=list)
 	completed: bool = False
+	response_id: str | None = None  # Id of the response stored at the provider (stateful Responses API)
+	response_provider: str | None = None  # Name of the provider that stores the response
+	index: int = 0  # Position of the exchange in the conversation
+	active_items: dict[typing.Any, typing.Any] = dataclasses.field(default_factory=dict)  # Items being streamed by their output / content block index
 
 	def get_last_item(self, item_type: typing.Literal['message', 'reasoning', 'function_call']) -> UserMessage|AssistentReasoning|FunctionCall:
 		for item in reversed(self.items):
@@ -115,21 +181,66 @@ class Exchange(pydantic.BaseModel):
 		return None
 
 
+class UserMessageCreated(pydantic.BaseModel):
+	"""The `user.message.created` message from the client, validated before it becomes an item of the conversation."""
+	content: pydantic.StrictStr = ''
+	model: pydantic.StrictStr | None = None
+
+
 class Conversation(pydantic.BaseModel):
 	"""A complete conversation."""
 	conversation_id: str
 	instructions: str
+	tenant: str | None = None
 	tools: list[FunctionCallTool] = pydantic.Field(default_factory=list)
 	created_at: datetime.datetime = pydantic.Field(default_factory=_utc_now)
 
 	exchanges: list[Exchange] = pydantic.Field(default_factory=list)
 
-	monitors: set[typing.Callable] = pydantic.Field(default_factory=set)
+	monitors: set[typing.Any] = pydantic.Field(default_factory=set)  # Clients of the conversation, `Monitor` instances
 		
 	tasks: list[typing.Callable] = pydantic.Field(default_factory=list)
+	payload_cache: dict[str, typing.Any] = pydantic.Field(default_factory=dict)  # Pre-serialized request history per provider type
+	context_window: typing.Any = None  # Part of the history that is sent to the model, see ContextManager
+	delta_coalescer: typing.Any = None  # Batching of `item.delta` events sent to monitors
+	replay_buffer: typing.Any = None  # Recent events with sequence numbers, for clients that reconnect
+	item_index: dict[str, typing.Any] = pydantic.Field(default_factory=dict)  # Item key -> exchange that contains the item
+	item_handles: dict[str, int] = pydantic.Field(default_factory=dict)  # Item key -> small integer handle, for the compact WebSocket subprotocol
 	loop_break: bool = True  # If true, then a LLMService will break an agentic loop and wait for the next user message
 
 
+	def add_exchange(self, exchange: Exchange) -> None:
+		exchange.index = len(self.exchanges)
+		self.exchanges.append(exchange)
+
+
+	def append_item(self, exchange: Exchange, item, index=None) -> None:
+		'''
+		Append the item to the exchange.
+		The `index` identifies the item in the stream of the LLM response (i.e. an output index), while the item is streamed.
+		'''
+		exchange.items.append(item)
+		if index is not None:
+			exchange.active_items[index] = item
+		self.item_index[item.key] = exchange
+		# Handles are never reused, not even when the conversation is truncated
+		self.item_handles.setdefault(item.key, len(self.item_handles) + 1)
+
+
+	def get_exchange_of_item(self, key: str) -> Exchange | None:
+		return self.item_index.get(key)
+
+
+	def truncate(self, exchange: Exchange) -> None:
+		'''
+		Remove the exchange and all that follow it.
+		'''
+		for removed in self.exchanges[exchange.index:]:
+			for item in removed.items:
+				self.item_index.pop(item.key, None)
+		del self.exchanges[exchange.index:]
+
+
 	def get_model(self) -> str | None:
 		'''
 		Get the model from the most recent item in the conversation.
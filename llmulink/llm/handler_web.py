@@ -1,36 +1,58 @@
-import json
 import weakref
 import asyncio
 import logging
 
 import asab.web.rest
 import aiohttp.web
+import pydantic
 
 
-from .datamodel import UserMessage
+from .datamodel import UserMessage, UserMessageCreated
+from .codec import loads, packb, unpackb, MSGPACK
 
 
 L = logging.getLogger(__name__)
 
+# MessagePack framing and integer item handles instead of item keys, negotiated by a client that asks for it
+COMPACT_PROTOCOL = 'asab.msgpack'
+
 
 class LLMWebHandler():
 	def __init__(self, app):
 		self.LLMRouterService = app.LLMRouterService
+		self.LLMModelCatalogService = app.LLMModelCatalogService
+
+		# JSON (`asab`) stays the default, a client selects the subprotocol by the order of its preference
+		self.Protocols = ('asab', COMPACT_PROTOCOL) if MSGPACK is not None else ('asab',)
+		self.Compress = asab.Config.getboolean("llm", "websocket_compress")
 		app.WebContainer.WebApp.router.add_get(r"/{tenant}/llm/conversation", self.ws_conversation)
+		app.WebContainer.WebApp.router.add_get(r"/{tenant}/llm/providers", self.providers)
 
 		self.Websockets = weakref.WeakSet()
 		app.PubSub.subscribe("Application.tick!", self.on_app_tick)
 
 
+	async def providers(self, request):
+		return asab.web.rest.json_response(
+			request,
+			data={
+				"result": "OK",
+				"data": [provider.to_dict() for provider in self.LLMRouterService.Providers],
+			}
+		)
+
+
 	async def ws_conversation(self, request):
 
-		models = await self.LLMRouterService.get_models()
+		models = await self.LLMModelCatalogService.get_models()
 		if models is None or len(models) == 0:
 			return asab.web.rest.json_response(request, {"result": "ERROR", "error": "No LLM models available"})
 
 		ws = aiohttp.web.WebSocketResponse(
 			receive_timeout=60.0,
-			protocols=('asab',)
+			protocols=self.Protocols,
+			# permessage-deflate, if the client supports it
+			compress=self.Compress,
 		)
 
 		conversation_id = request.query.get('conversation_id')
@@ -40,26 +62,44 @@ class LLMWebHandler():
 			conversation = await self.LLMRouterService.get_conversation(conversation_id, create=True)
 
 		await ws.prepare(request)
+		compact = ws.ws_protocol == COMPACT_PROTOCOL
 
-		await ws.send_json({
+		mounted = {
 			"type": "chat.mounted",
 			"conversation_id": conversation.conversation_id,
 			"models": models,
-		})
+		}
+		if compact:
+			await ws.send_bytes(packb(mounted))
+		else:
+			await ws.send_json(mounted)
 
 		self.Websockets.add(ws)
 
-		async def reply_to_client(data):
+		async def reply_to_client(event):
 			"""
 			Closure that is responsible for sending replay from the LLM (etc) to the client.
-			Works as a monitor for the conversation.
+			Works as a monitor for the conversation, the `event` is an `EncodedEvent`.
 			"""
-			await ws.send_json(data)
+			if compact:
+				await ws.send_bytes(event.packed(conversation.item_handles))
+			else:
+				# The encoded JSON is sent as it is, without decoding to `str` and encoding again
+				await ws.send_frame(event.data, aiohttp.WSMsgType.TEXT)
 
-		# Send initial full update so that the client has the current state of the conversation
-		await self.LLMRouterService.send_full_update(conversation, reply_to_client)
+		# The monitor queues events for the client, so that a slow client doesn't stall the conversation
+		monitor = self.LLMRouterService.create_monitor(conversation, reply_to_client, close=ws.close)
+
+		# A client that reconnects tells the last event it has seen, it gets only the events it has missed
+		last_seq = request.query.get('last_seq')
+		try:
+			last_seq = int(last_seq) if last_seq is not None else None
+		except ValueError:
+			last_seq = None
+
+		# Send initial full update (or missed events) so that the client has the current state of the conversation
+		await self.LLMRouterService.attach_monitor(conversation, monitor, last_seq=last_seq)
 
-		conversation.monitors.add(reply_to_client)
 		try:
 			async for msg in ws:
 
@@ -67,12 +107,24 @@ class LLMWebHandler():
 
 					match (msg.type):
 
-						case aiohttp.WSMsgType.TEXT:
-							data = json.loads(msg.data)
+						case aiohttp.WSMsgType.TEXT | aiohttp.WSMsgType.BINARY:
+							if msg.type == aiohttp.WSMsgType.TEXT:
+								data = loads(msg.data)
+							elif compact:
+								data = unpackb(msg.data)
+							else:
+								L.warning("Binary message received, the compact subprotocol is not negotiated")
+								continue
+
 							match data.get('type'):
 
 								case 'user.message.created':
-									user_message = UserMessage(role='user', content=data.get('content', ''), model=data.get('model', models[0]))
+									try:
+										message = UserMessageCreated.model_validate(data)
+									except pydantic.ValidationError as e:
+										L.warning("Invalid user message received", struct_data={"error": str(e)})
+										continue
+									user_message = UserMessage(role='user', content=message.content, model=message.model or models[0])
 									await self.LLMRouterService.create_exchange(conversation, user_message)
 
 								case 'conversation.stop':
@@ -80,20 +132,20 @@ class LLMWebHandler():
 
 								case 'conversation.restart':
 									self.LLMRouterService.restart_conversation(conversation, key=data.get('key'))
-									await self.LLMRouterService.send_full_update(conversation, reply_to_client)
+									await self.LLMRouterService.send_full_update(conversation, monitor)
 
 								case 'conversation.instructions.update':
 									await self.LLMRouterService.update_instructions(conversation, data.get('item'), data.get('params', {}))
 
 								case 'update.full.requested':
-									await self.LLMRouterService.send_full_update(conversation, reply_to_client)
+									await self.LLMRouterService.send_full_update(conversation, monitor)
+
+								case 'update.page.requested':
+									await self.LLMRouterService.send_page(conversation, monitor, int(data.get('cursor', 0)))
 
 								case _:
 									L.warning("Unknown message type receive", struct_data={"data": data})
 
-						case aiohttp.WSMsgType.BINARY:
-							print("aiohttp.WSMsgType.BINARY>", msg.data)
-
 						case aiohttp.WSMsgType.CLOSE:
 							print("aiohttp.WSMsgType.CLOSE!")
 							await ws.close()
@@ -108,7 +160,7 @@ class LLMWebHandler():
 					break
 		
 		finally:
-			conversation.monitors.discard(reply_to_client)
+			self.LLMRouterService.detach_monitor(conversation, monitor)
 
 		return ws
 
@@ -0,0 +1,165 @@
+import time
+import asyncio
+import logging
+
+import asab
+
+from .provider.provider_abc import LLMProviderError
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class HedgedChatRequest:
+	'''
+	A chat request that can be served by any of the providers of the model.
+
+	If the first token doesn't arrive within `hedge_after` seconds since the admission to a provider,
+	the same request is sent also to another provider (at most `hedge_max` times).
+	The first request that streams a token wins and the others are cancelled.
+
+	A request that fails on the side of the provider (connection error, 5xx, 429) before streaming
+	fails over to the remaining providers.
+	When there is no provider left and the failure was 429 or 503, the request is retried after a backoff
+	according to the retry policy of the provider. The backoff is spent outside of the admission queue,
+	so that the waiting request doesn't hold a provider slot.
+	'''
+
+	def __init__(self, router, conversation, exchange, providers, *, hedge_after=0.0, hedge_max=1):
+		self.Router = router
+		self.Conversation = conversation
+		self.Exchange = exchange
+		self.Providers = providers
+		self.HedgeAfter = hedge_after
+		self.HedgeMax = hedge_max
+
+		self.Attempts = set()
+		self.Tried = set()  # Providers that have been admitted for an attempt
+		self.Pending = 0  # Number of attempts waiting in the admission queue
+		self.AdmittedAt = None
+		self.Hedges = 0
+		self.Retries = 0
+		self.Winner = None  # The attempt that streamed the first token
+		self.Changed = asyncio.Event()
+
+
+	async def run(self) -> None:
+		if not self._start(notify=True):
+			raise LLMProviderError(None, "No healthy provider available for the model")
+		try:
+			while len(self.Attempts) > 0:
+				self.Changed.clear()
+				changed = asyncio.ensure_future(self.Changed.wait())
+				try:
+					done, _ = await asyncio.wait(
+						self.Attempts | {changed},
+						timeout=self._hedge_timeout(),
+						return_when=asyncio.FIRST_COMPLETED
+					)
+				finally:
+					changed.cancel()
+
+				if len(done) == 0:
+					# The first token didn't arrive in time
+					self.Hedges += 1
+					if self._start(notify=False):
+						L.log(asab.LOG_NOTICE, "Hedging a slow chat request", struct_data={"conversation_id": self.Conversation.conversation_id})
+					continue
+
+				for task in done:
+					if task is changed:
+						continue
+
+					self.Attempts.discard(task)
+					if task.cancelled():
+						continue
+
+					error = task.exception()
+					if error is None:
+						return
+
+					if task is self.Winner or not isinstance(error, LLMProviderError) or not (error.failover or error.retryable):
+						raise error
+
+					if self.Winner is not None or len(self.Attempts) > 0:
+						# Another attempt is still in the game
+						continue
+
+					if error.failover and self._start(notify=True):
+						L.warning(
+							"Chat request failed, failing over to another provider",
+							struct_data={"conversation_id": self.Conversation.conversation_id, "provider": error.Provider.Name, "status": error.Status, "error": str(error)}
+						)
+						continue
+
+					delay = error.Provider.RetryPolicy.get_delay(self.Retries, error.RetryAfter) if error.retryable else None
+					if delay is None:
+						raise error
+
+					L.warning(
+						"Chat request rejected by the provider, retrying",
+						struct_data={"conversation_id": self.Conversation.conversation_id, "provider": error.Provider.Name, "status": error.Status, "delay": delay}
+					)
+					self.Retries += 1
+					self.Tried.clear()
+					if not self._start(notify=True, delay=delay):
+						raise error
+
+		finally:
+			for task in self.Attempts:
+				task.cancel()
+
+
+	def _start(self, notify: bool, delay: float = 0.0) -> bool:
+		candidates = [provider for provider in self.Providers if provider not in self.Tried and provider.Health.available]
+		if len(candidates) == 0:
+			return False
+
+		self.Attempts.add(asyncio.create_task(
+			self._attempt(candidates, notify, delay),
+			name=f"conversation-{self.Conversation.conversation_id}-attempt"
+		))
+		return True
+
+
+	def _hedge_timeout(self) -> float | None:
+		if self.HedgeAfter <= 0 or self.Winner is not None or self.Hedges >= self.HedgeMax:
+			return None
+		if self.Pending > 0 or self.AdmittedAt is None:
+			return None
+		if all(provider in self.Tried or not provider.Health.available for provider in self.Providers):
+			return None
+		return max(0.0, self.AdmittedAt + self.HedgeAfter - time.monotonic())
+
+
+	async def _attempt(self, candidates: list, notify: bool, delay: float) -> None:
+		self.Pending += 1
+		try:
+			if delay > 0:
+				await asyncio.sleep(delay)
+			provider = await self.Router.AdmissionQueue.admit(self.Conversation, candidates, notify=notify)
+		finally:
+			self.Pending -= 1
+
+		self.Tried.add(provider)
+		self.AdmittedAt = time.monotonic()
+		self.Changed.set()
+
+		task = asyncio.current_task()
+
+		def on_first_token():
+			self.Winner = task
+			for other in self.Attempts:
+				if other is not task:
+					other.cancel()
+			self.Changed.set()
+
+		provider.Stats.InFlight += 1
+		try:
+			await provider.chat_request(self.Conversation, self.Exchange, on_first_token)
+		finally:
+			provider.Stats.InFlight -= 1
+			provider.Limiter.release()
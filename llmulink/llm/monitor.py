@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import collections
+
+from .codec import EncodedEvent
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+
+class Monitor:
+	'''
+	A client of a conversation (i.e. a WebSocket) with its own bounded queue of outbound events.
+
+	Events are put to the queue without waiting and a writer task sends them to the client,
+	so that a slow client never blocks the LLM stream nor other clients of the conversation.
+	When the queue is full, the overflow policy applies:
+
+	coalesce: consecutive deltas of the same item in the queue are merged, if that doesn't help then `snapshot` follows.
+	snapshot: queued events are dropped and the client receives a full update instead.
+	disconnect: the client is disconnected, it may reconnect and catch up by the replay of missed events.
+	'''
+
+	__slots__ = ('Send', 'Snapshot', 'Close', 'Size', 'Policy', 'Counter', 'Queue', 'Ready', 'SnapshotPending', 'Snapshotting', 'SkipUntil', 'Task')
+
+	def __init__(self, send, *, size: int, policy: str, snapshot, close=None, counter=None):
+		self.Send = send  # Coroutine function that sends an `EncodedEvent` to the client
+		self.Snapshot = snapshot  # Coroutine function that builds a full update, as an `EncodedEvent`
+		self.Close = close  # Coroutine function that disconnects the client
+		self.Size = size
+		self.Policy = policy
+		self.Counter = counter
+
+		self.Queue = collections.deque()
+		self.Ready = asyncio.Event()
+		self.SnapshotPending = False
+		self.Snapshotting = False  # The snapshot is being built, its sequence number is not known yet
+		self.SkipUntil = None  # Events up to this sequence number are already in the snapshot sent
+		self.Task = asyncio.create_task(self._writer(), name="conversation-monitor-writer")
+
+
+	def put(self, event: EncodedEvent) -> None:
+		if self.Task.done():
+			return
+
+		if len(self.Queue) >= self.Size:
+			if not self._on_overflow():
+				return
+
+		self.Queue.append(event)
+		self.Ready.set()
+
+
+	def stop(self) -> None:
+		self.Task.cancel()
+		self.Queue.clear()
+
+
+	def _on_overflow(self) -> bool:
+		'''
+		Make room in the queue, returns False if the event is not to be queued.
+		'''
+		if self.Policy == 'coalesce' and not self.Snapshotting:
+			# While the snapshot is being built, it is not known which queued events it covers, so nothing is merged
+			self._coalesce()
+			if len(self.Queue) < self.Size:
+				self._count("coalesced")
+				return True
+
+		if self.Policy == 'disconnect':
+			self._count("disconnected")
+			L.warning("Client is too slow, disconnecting")
+			self.stop()
+			if self.Close is not None:
+				asyncio.create_task(self.Close())
+			return False
+
+		self._count("snapshot")
+		self.Queue.clear()
+		self.SnapshotPending = True
+		self.Ready.set()
+		# The snapshot will contain the event
+		return False
+
+
+	def _coalesce(self) -> None:
+		queue = collections.deque()
+		for event in self.Queue:
+			if len(queue) > 0 and event.Event["type"] == "item.delta":
+				last = queue[-1]
+				if last.Event["type"] == "item.delta" and last.Event["key"] == event.Event["key"]:
+					queue[-1] = EncodedEvent(dict(event.Event, delta=last.Event["delta"] + event.Event["delta"]), event.Seq)
+					continue
+			queue.append(event)
+		self.Queue = queue
+
+
+	def _count(self, name: str) -> None:
+		if self.Counter is not None:
+			self.Counter.add(name, 1)
+
+
+	async def _writer(self) -> None:
+		try:
+			while True:
+				if len(self.Queue) == 0 and not self.SnapshotPending:
+					self.Ready.clear()
+					await self.Ready.wait()
+					continue
+
+				if self.SnapshotPending:
+					self.SnapshotPending = False
+					self.Snapshotting = True
+					try:
+						event = await self.Snapshot()
+					finally:
+						self.Snapshotting = False
+					self.SkipUntil = event.Seq
+					# Events queued while the snapshot was built may be in it already
+					if event.Seq is not None:
+						self.Queue = collections.deque(e for e in self.Queue if e.Seq is None or e.Seq > event.Seq)
+					await self.Send(event)
+					continue
+
+				event = self.Queue.popleft()
+				if self.SkipUntil is not None and event.Seq is not None and event.Seq <= self.SkipUntil:
+					continue
+				await self.Send(event)
+
+		except asyncio.CancelledError:
+			raise
+
+		except Exception:
+			L.exception("Error sending event to the client, disconnecting")
+			self.Queue.clear()
+			# The client reconnects and catches up, the router detaches the monitor when the connection closes
+			if self.Close is not None:
+				asyncio.create_task(self.Close())
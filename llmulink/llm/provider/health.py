@@ -0,0 +1,112 @@
+import time
+import collections
+
+
+class CircuitBreaker:
+	'''
+	Health state of a LLM chat provider.
+
+	closed: the provider is healthy and receives requests.
+	open: the provider failed repeatedly (consecutive failures or error rate in the recent window),
+		it receives no requests until a liveness probe (`v1/models`) succeeds after `open_timeout`.
+	half_open: a single trial request is let through, its outcome closes or reopens the circuit.
+	'''
+
+	def __init__(self, *, failure_threshold=5, error_rate=0.5, window=20, open_timeout=30.0, on_change=None):
+		self.FailureThreshold = failure_threshold
+		self.ErrorRate = error_rate
+		self.OpenTimeout = open_timeout
+		self.OnChange = on_change
+
+		self.State = 'closed'
+		self.ConsecutiveFailures = 0
+		self.Outcomes = collections.deque(maxlen=window)  # True for a success, False for a failure
+		self.OpenedAt = None
+		self.TrialStartedAt = None
+		self.Probing = False
+
+
+	@property
+	def available(self) -> bool:
+		match self.State:
+			case 'closed':
+				return True
+			case 'half_open':
+				# Only one trial request at a time; a trial that didn't report back in time is considered lost
+				return self.TrialStartedAt is None or time.monotonic() - self.TrialStartedAt > self.OpenTimeout
+			case _:
+				return False
+
+
+	def probe_due(self) -> bool:
+		return self.State == 'open' and not self.Probing and time.monotonic() - self.OpenedAt >= self.OpenTimeout
+
+
+	def on_admit(self) -> None:
+		if self.State == 'half_open':
+			self.TrialStartedAt = time.monotonic()
+
+
+	def on_cancel(self) -> None:
+		self.TrialStartedAt = None
+
+
+	def on_success(self) -> None:
+		self.ConsecutiveFailures = 0
+		self.Outcomes.append(True)
+		self.TrialStartedAt = None
+		if self.State != 'closed':
+			self.Outcomes.clear()
+			self._set_state('closed')
+
+
+	def on_failure(self) -> None:
+		self.ConsecutiveFailures += 1
+		self.Outcomes.append(False)
+		self.TrialStartedAt = None
+
+		match self.State:
+			case 'half_open':
+				self._open()
+
+			case 'closed':
+				if self.ConsecutiveFailures >= self.FailureThreshold:
+					self._open()
+				elif len(self.Outcomes) >= self.Outcomes.maxlen // 2 and self.Outcomes.count(False) / len(self.Outcomes) >= self.ErrorRate:
+					self._open()
+
+
+	def on_probe(self, ok: bool) -> None:
+		'''
+		Outcome of a liveness probe (`v1/models` call).
+		'''
+		if self.State == 'open':
+			if ok:
+				self._set_state('half_open')
+			else:
+				# Wait another timeout before the next probe
+				self.OpenedAt = time.monotonic()
+
+		elif not ok:
+			self.on_failure()
+
+
+	def _open(self) -> None:
+		self.OpenedAt = time.monotonic()
+		self._set_state('open')
+
+
+	def _set_state(self, state: str) -> None:
+		if self.State == state:
+			return
+		self.State = state
+		if self.OnChange is not None:
+			self.OnChange()
+
+
+	def to_dict(self) -> dict:
+		return {
+			"state": self.State,
+			"consecutive_failures": self.ConsecutiveFailures,
+			"error_rate": (self.Outcomes.count(False) / len(self.Outcomes)) if len(self.Outcomes) > 0 else 0.0,
+		}
@@ -0,0 +1,109 @@
+import time
+
+
+class ConcurrencyLimiter:
+	'''
+	Limits the number of concurrent requests to a LLM chat provider.
+
+	Slots are taken by `try_acquire()` only, requests that wait for a slot wait in the admission queue,
+	which is notified by `OnAvailable` when a slot may have become available.
+
+	In the adaptive mode, the limit follows AIMD (additive increase, multiplicative decrease):
+	it grows by one slot per "limit" successful requests while the time to first token and error rate stay healthy,
+	and it is cut by `decrease_factor` on 429/503 responses, errors or when the time to first token spikes.
+	'''
+
+	def __init__(self, limit: int, *, adaptive=False, min_limit=1, max_limit=64, latency_tolerance=2.0, decrease_factor=0.5, max_error_rate=0.1, gauge=None):
+		self.Limit = float(limit)
+		self.InUse = 0
+
+		self.Adaptive = adaptive
+		self.MinLimit = min_limit
+		self.MaxLimit = max_limit
+		self.LatencyTolerance = latency_tolerance  # TTFT above `tolerance * baseline` is a spike
+		self.DecreaseFactor = decrease_factor
+		self.MaxErrorRate = max_error_rate
+
+		self.BaselineTTFT = None  # Slow moving average of the time to first token
+		self.ErrorRate = 0.0  # Moving average of failed requests
+		self.DecreasedAt = 0.0
+
+		self.Gauge = gauge
+		self.OnAvailable = None  # Callback, called when a slot may have become available
+		self._update_gauge()
+
+
+	@property
+	def available(self) -> bool:
+		return self.InUse < int(self.Limit)
+
+
+	def try_acquire(self) -> bool:
+		if not self.available:
+			return False
+		self.InUse += 1
+		self._update_gauge()
+		return True
+
+
+	def release(self) -> None:
+		self.InUse -= 1
+		self._wake()
+
+
+	def _wake(self) -> None:
+		self._update_gauge()
+
+		if self.OnAvailable is not None and self.available:
+			self.OnAvailable()
+
+
+	def on_request_done(self, request_stats) -> None:
+		'''
+		Adapt the limit to the outcome of the finished request.
+		'''
+		if not self.Adaptive:
+			return
+
+		if request_stats.Status in (429, 503):
+			self.ErrorRate = 0.9 * self.ErrorRate + 0.1
+			self._decrease()
+			return
+
+		if request_stats.FirstTokenAt is None:
+			# The request failed without producing any output
+			self.ErrorRate = 0.9 * self.ErrorRate + 0.1
+			if self.ErrorRate > self.MaxErrorRate:
+				self._decrease()
+			return
+
+		self.ErrorRate = 0.9 * self.ErrorRate
+		ttft = request_stats.FirstTokenAt - request_stats.StartedAt
+		if self.BaselineTTFT is None:
+			self.BaselineTTFT = ttft
+		elif ttft > self.LatencyTolerance * self.BaselineTTFT:
+			self._decrease()
+			return
+		else:
+			self.BaselineTTFT = 0.95 * self.BaselineTTFT + 0.05 * ttft
+
+		if self.ErrorRate <= self.MaxErrorRate:
+			self.Limit = min(self.MaxLimit, self.Limit + 1.0 / self.Limit)
+			self._wake()
+
+
+	def _decrease(self) -> None:
+		# Requests that were in flight together tend to fail together, decrease only once per such a group
+		now = time.monotonic()
+		if now - self.DecreasedAt < max(1.0, self.BaselineTTFT or 0.0):
+			return
+		self.DecreasedAt = now
+		self.Limit = max(self.MinLimit, self.Limit * self.DecreaseFactor)
+		self._update_gauge()
+
+
+	def _update_gauge(self) -> None:
+		if self.Gauge is None:
+			return
+		self.Gauge.set("limit", int(self.Limit))
+		self.Gauge.set("in_use", self.InUse)
@@ -0,0 +1,56 @@
+from ..codec import dumps
+
+
+class PayloadCache:
+	'''
+	Pre-serialized prefix of the conversation history, in the request format of one provider type.
+
+	Only items that will not change anymore are cached, so that every turn encodes just the new items.
+	The cache must be invalidated (`conversation.payload_cache.clear()`) when the history or instructions are rewritten.
+	'''
+
+	__slots__ = ('Exchange', 'Item', 'Fragments', 'Tools')
+
+	def __init__(self):
+		# Position of the first item that is not cached yet
+		self.Exchange = 0
+		self.Item = 0
+
+		self.Fragments = []  # JSON encoded entries of the history
+		self.Tools = None  # JSON encoded tools, b'' if there are no tools
+
+
+def is_final(item) -> bool:
+	'''
+	The item will not change anymore.
+	'''
+	match item.type:
+		case 'function_call':
+			# The output of the function call is ready
+			return item.status == 'finished'
+		case _:
+			return getattr(item, 'status', None) != 'in_progress'
+
+
+def encode_json(obj) -> bytes:
+	return dumps(obj)
+
+
+def encode_array(fragments: list[bytes]) -> bytes:
+	return b'[' + b','.join(fragments) + b']'
+
+
+def encode_payload(data: dict, encoded: dict[str, bytes]) -> bytes:
+	'''
+	Encode the request payload.
+	The `encoded` values are already JSON encoded and they are inserted to the payload as they are.
+	'''
+	parts = [encode_json(data)[:-1]]  # Strip the closing brace
+	for key, value in encoded.items():
+		if len(parts) > 1 or len(data) > 0:
+			parts.append(b',')
+		parts.append(encode_json(key))
+		parts.append(b':')
+		parts.append(value)
+	parts.append(b'}')
+	return b''.join(parts)
@@ -1,18 +1,117 @@
 import abc
+import typing
+import asyncio
 import logging
 import aiohttp
 
 import asab
 
 from ..datamodel import Conversation, Exchange
+from .stats import ProviderStats
+from .limiter import ConcurrencyLimiter
+from .health import CircuitBreaker
+from .retry import RetryPolicy
+from .payload import PayloadCache, is_final, encode_json, encode_array
+from .sse import SSEParser, SSEEvent
 
 L = logging.getLogger("llmulink.llm")
 
+
+class LLMProviderError(Exception):
+	'''
+	The request to the LLM chat provider failed.
+
+	`status` is the HTTP status of the response or None if the provider could not be reached or timed out.
+	`streamed` is True if the provider already produced an output into the exchange before the failure.
+	'''
+
+	def __init__(self, provider, message, *, status=None, retry_after=None, streamed=False):
+		super().__init__(message)
+		self.Provider = provider
+		self.Status = status
+		self.RetryAfter = retry_after
+		self.Streamed = streamed
+
+
+	@property
+	def failover(self) -> bool:
+		'''
+		The request may be sent to another provider: the provider is unreachable, overloaded or failed on its side.
+		'''
+		return not self.Streamed and (self.Status is None or self.Status >= 500 or self.Status == 429)
+
+
+	@property
+	def retryable(self) -> bool:
+		'''
+		The provider asked to try the request later.
+		'''
+		return not self.Streamed and self.Status in (429, 503)
+
+
+	@property
+	def unhealthy(self) -> bool:
+		'''
+		The failure indicates that the provider is not healthy; rate limiting (429, 503) is not such a case.
+		'''
+		return self.Status is None or (self.Status >= 500 and self.Status != 503)
+
+
 class LLMChatProviderABC(abc.ABC):
-	def __init__(self, service, *, url):
+	def __init__(self, service, *, url, **kwargs):
 		self.LLMChatService = service
 		self.URL = url.rstrip('/') + '/'
 		self.Models = []  # Cached list of models
+		self.Stats = ProviderStats()
+
+		# Persistent HTTP session, created lazily in the event loop
+		# TCP_NODELAY is set by aiohttp on every connection
+		self.Session = None
+		self.ConnectionLimitPerHost = int(kwargs.get('connection_limit_per_host', 100))
+		self.KeepAliveTimeout = float(kwargs.get('keepalive_timeout', 60))
+		self.DNSCacheTTL = int(kwargs.get('dns_cache_ttl', 300))
+
+		# Timeouts of streaming requests, in seconds
+		self.TimeoutConnect = float(kwargs.get('timeout_connect', 10))
+		self.TimeoutFirstToken = float(kwargs.get('timeout_first_token', 120))  # Time to the first byte / token
+		self.TimeoutIdle = float(kwargs.get('timeout_idle', 60))  # Maximum gap between chunks of the stream
+		self.TimeoutTotal = float(kwargs.get('timeout_total', 1800))
+
+		# Events of the stream are read into a bounded queue, apart from their processing
+		self.StreamQueueSize = int(kwargs.get('stream_queue', 256))
+
+		self.Name = kwargs.get('name', self.URL)
+		self.Limiter = ConcurrencyLimiter(
+			int(kwargs.get('concurrency', 2)),
+			adaptive=string_to_boolean(kwargs.get('concurrency_adaptive', 'no')),
+			min_limit=int(kwargs.get('concurrency_min', 1)),
+			max_limit=int(kwargs.get('concurrency_max', 64)),
+			gauge=service.MetricsService.create_gauge(
+				"llm_provider_concurrency",
+				tags={"provider": self.Name},
+				init_values={"limit": 0, "in_use": 0},
+			),
+		)
+
+		self.StreamGauge = service.MetricsService.create_gauge(
+			"llm_provider_stream",
+			tags={"provider": self.Name},
+			init_values={"depth": 0, "lag": 0.0},
+		)
+		self.StreamLoads = dict[asyncio.Queue, tuple[int, float]]()  # Depth and lag of each stream being read
+
+		self.RetryPolicy = RetryPolicy(
+			max_attempts=int(kwargs.get('retry_max_attempts', 3)),
+			backoff=float(kwargs.get('retry_backoff', 1)),
+			backoff_max=float(kwargs.get('retry_backoff_max', 30)),
+		)
+
+		self.Health = CircuitBreaker(
+			failure_threshold=int(kwargs.get('circuit_failure_threshold', 5)),
+			error_rate=float(kwargs.get('circuit_error_rate', 0.5)),
+			open_timeout=float(kwargs.get('circuit_open_timeout', 30)),
+			on_change=lambda: service.on_provider_health_changed(self),
+		)
 
 		L.log(asab.LOG_NOTICE, "Loaded provider", struct_data={"url": self.URL, "type": self.__class__.__name__})
 
@@ -20,38 +119,319 @@ class LLMChatProviderABC(abc.ABC):
 	def prepare_headers(self):
 		pass
 
+	def get_session(self) -> aiohttp.ClientSession:
+		'''
+		Get the long-lived HTTP session of the provider, connections are reused across requests.
+		'''
+		if self.Session is None or self.Session.closed:
+			connector = aiohttp.TCPConnector(
+				limit=0,  # The number of connections is governed per host
+				limit_per_host=self.ConnectionLimitPerHost,
+				keepalive_timeout=self.KeepAliveTimeout,
+				ttl_dns_cache=self.DNSCacheTTL,
+			)
+			self.Session = aiohttp.ClientSession(
+				connector=connector,
+				headers=self.prepare_headers(),
+				# Reading of streams is guarded by `read_events()`, the total duration by `send_request()`
+				timeout=aiohttp.ClientTimeout(total=None, connect=self.TimeoutConnect, sock_read=self.TimeoutFirstToken),
+			)
+		return self.Session
+
+	def to_dict(self) -> dict:
+		return {
+			"name": self.Name,
+			"type": self.__class__.__name__,
+			"url": self.URL,
+			"models": [model['id'] for model in self.Models],
+			"health": self.Health.to_dict(),
+			"stats": self.Stats.to_dict(),
+			"concurrency": {
+				"limit": int(self.Limiter.Limit),
+				"in_use": self.Limiter.InUse,
+			},
+		}
+
+	async def close(self):
+		if self.Session is not None:
+			await self.Session.close()
+			self.Session = None
+
+	@abc.abstractmethod
+	async def chat_request(self, conversation: Conversation, exchange: Exchange, on_first_token=None):
+		pass
+
 	@abc.abstractmethod
-	async def chat_request(self, conversation: Conversation, exchange: Exchange):
+	async def _stream_request(self, conversation: Conversation, exchange: Exchange, payload: bytes, request_stats) -> None:
 		pass
 
+	@abc.abstractmethod
+	def _build_history_item(self, item) -> list[dict]:
+		'''
+		Convert the conversation item into entries of the request history (`input` or `messages`).
+		'''
+		pass
+
+	@abc.abstractmethod
+	def _build_tools(self, conversation: Conversation) -> list[dict]:
+		pass
+
+	def get_payload_cache(self, conversation: Conversation) -> PayloadCache:
+		# The format of the request is given by the provider type, so the cache is shared by providers of the same type
+		cache = conversation.payload_cache.get(self.__class__.__name__)
+		if cache is None:
+			cache = conversation.payload_cache[self.__class__.__name__] = PayloadCache()
+		return cache
+
+	def encode_history(self, conversation: Conversation, prefix: list[bytes] | None = None) -> bytes:
+		'''
+		Encode the conversation history as a JSON array, optionally preceded by already encoded `prefix` entries.
+		Items that will not change anymore are encoded only once and cached across turns.
+		'''
+		return encode_array(self.get_history_fragments(conversation, prefix))
+
+	def get_history_fragments(self, conversation: Conversation, prefix: list[bytes] | None = None) -> list[bytes]:
+		'''
+		Get JSON encoded entries of the conversation history.
+		Only the context window of the conversation is included, if it is set.
+		The returned list may be the cache itself, it must not be modified.
+		'''
+		cache = self.get_payload_cache(conversation)
+		tail = []
+		caching = True
+
+		window = conversation.context_window
+		if window is not None:
+			if window.SummaryItem is not None:
+				prefix = (prefix or []) + [encode_json(entry) for entry in self._build_history_item(window.SummaryItem)]
+			if cache.Exchange < window.Start:
+				cache.Exchange, cache.Item = window.Start, 0
+
+		exchanges = conversation.exchanges
+		ei, ii = cache.Exchange, cache.Item
+		while ei < len(exchanges):
+			items = exchanges[ei].items
+			while ii < len(items):
+				item = items[ii]
+				if window is not None:
+					item = window.get_item(item)
+				fragments = [encode_json(entry) for entry in self._build_history_item(item)]
+				ii += 1
+				if caching and is_final(item):
+					cache.Fragments.extend(fragments)
+					cache.Exchange, cache.Item = ei, ii
+				else:
+					caching = False
+					tail.extend(fragments)
+			ei += 1
+			ii = 0
+			if caching:
+				cache.Exchange, cache.Item = ei, 0
+
+		fragments = cache.Fragments
+		if prefix is not None or len(tail) > 0:
+			fragments = (prefix or []) + fragments + tail
+		return fragments
+
+	def encode_tools(self, conversation: Conversation) -> bytes | None:
+		'''
+		Encode the tools of the conversation as a JSON array, None if there are no tools.
+		'''
+		cache = self.get_payload_cache(conversation)
+		if cache.Tools is None:
+			tools = self._build_tools(conversation)
+			cache.Tools = encode_json(tools) if len(tools) > 0 else b''
+		return cache.Tools if len(cache.Tools) > 0 else None
+
+	async def send_request(self, conversation: Conversation, exchange: Exchange, payload: bytes, on_first_token=None) -> None:
+		'''
+		Send the prepared request to the provider and stream the response into the exchange.
+		The outcome of the request is recorded in the provider statistics and the concurrency limiter.
+
+		`on_first_token` is called when the first output arrives, before it is applied to the exchange.
+
+		Raises LLMProviderError if the request fails.
+		'''
+		request_stats = self.Stats.request()
+		request_stats.OnFirstToken = on_first_token
+		try:
+			async with asyncio.timeout(self.TimeoutTotal):
+				await self._stream_request(conversation, exchange, payload, request_stats)
+
+		except asyncio.CancelledError:
+			# A cancelled request (i.e. a loser of a hedged request) tells only that the first token took at least this long,
+			# it is not a failure of the provider for the limiter nor for the health
+			request_stats.abandon()
+			request_stats = None
+			self.Health.on_cancel()
+			raise
+
+		except aiohttp.ClientError as e:
+			self.Health.on_failure()
+			raise LLMProviderError(
+				self, "{}: {}".format(e.__class__.__name__, e),
+				status=request_stats.Status,
+				streamed=request_stats.FirstTokenAt is not None,
+			) from e
+
+		except TimeoutError as e:
+			self.Health.on_failure()
+			raise LLMProviderError(
+				self, "Timeout, the request to LLM chat provider took longer than {}s".format(self.TimeoutTotal),
+				streamed=request_stats.FirstTokenAt is not None,
+			) from e
+
+		except LLMProviderError as e:
+			if e.unhealthy:
+				self.Health.on_failure()
+			else:
+				# The provider is alive, it just didn't like the request (or asked to slow down)
+				self.Health.on_success()
+			raise
+
+		else:
+			self.Health.on_success()
+
+		finally:
+			if request_stats is not None:
+				request_stats.close()
+				self.Limiter.on_request_done(request_stats)
+
+
+	async def read_events(self, response, request_stats) -> typing.AsyncGenerator[SSEEvent, None]:
+		'''
+		Iterate over Server-Sent Events of the streamed response.
+
+		The response is read and parsed by a separate task into a bounded queue,
+		so that reading from the socket doesn't wait for the processing of each event.
+		Iterate within `contextlib.aclosing()`, so that the reader ends together with the iteration.
+
+		Raises LLMProviderError if the first token doesn't arrive in time or the stream stalls.
+		'''
+		loop = asyncio.get_running_loop()
+		queue = asyncio.Queue(maxsize=self.StreamQueueSize)
+		reader = asyncio.create_task(self._read_stream(response, request_stats, queue))
+		try:
+			while True:
+				received_at, item = await queue.get()
+				# Events waiting for the processing and how late the processing is
+				self.StreamLoads[queue] = (queue.qsize(), loop.time() - received_at)
+				self._update_stream_gauge()
+
+				if item is None:
+					return
+				if isinstance(item, Exception):
+					raise item
+				yield item
+
+		finally:
+			reader.cancel()
+			self.StreamLoads.pop(queue, None)
+			self._update_stream_gauge()
+
+
+	def _update_stream_gauge(self) -> None:
+		'''
+		Report the most loaded of concurrent streams of the provider.
+		'''
+		loads = self.StreamLoads.values()
+		self.StreamGauge.set("depth", max((depth for depth, _ in loads), default=0))
+		self.StreamGauge.set("lag", max((lag for _, lag in loads), default=0.0))
+
+
+	async def _read_stream(self, response, request_stats, queue: asyncio.Queue) -> None:
+		'''
+		Read the response into the queue of events, the end of the stream is marked by None, a failure by the exception.
+		'''
+		loop = asyncio.get_running_loop()
+		content = response.content
+		parser = SSEParser()
+		try:
+			while True:
+				if request_stats.FirstTokenAt is None:
+					deadline = request_stats.StartedAt + self.TimeoutFirstToken
+				else:
+					deadline = loop.time() + self.TimeoutIdle
+
+				try:
+					async with asyncio.timeout_at(deadline):
+						chunk = await content.readany()
+				except TimeoutError as e:
+					if request_stats.FirstTokenAt is None:
+						message = "Timeout, no token from LLM chat provider in {}s".format(self.TimeoutFirstToken)
+					else:
+						message = "Timeout, the stream from LLM chat provider stalled for {}s".format(self.TimeoutIdle)
+					raise LLMProviderError(self, message, streamed=request_stats.FirstTokenAt is not None) from e
+
+				if len(chunk) == 0:
+					break
+
+				received_at = loop.time()
+				for event in parser.feed(chunk):
+					await queue.put((received_at, event))
+
+			await queue.put((loop.time(), None))
+
+		except asyncio.CancelledError:
+			raise
+
+		except Exception as e:
+			await queue.put((loop.time(), e))
+
+
+	async def raise_for_status(self, response, request_stats) -> None:
+		'''
+		Raise LLMProviderError if the response of the provider is not successful.
+		'''
+		request_stats.Status = response.status
+		if response.status == 200:
+			return
+
+		text = await response.text()
+		raise LLMProviderError(
+			self, "Error when sending request to LLM chat provider: {} {}".format(response.status, text),
+			status=response.status,
+			retry_after=response.headers.get('Retry-After'),
+		)
+
 	async def get_models(self):
 		'''
 		Get the list of models from the LLM chat provider.
 		Implements /v1/models call that works with vLLM, tensorrm-llm, OpenAI and Anthropic API and possibly other LLM chat providers.
 		'''
 
-		async with aiohttp.ClientSession(headers=self.prepare_headers()) as session:
-			try:
-				async with session.get(self.URL + "v1/models") as response:
-					if response.status != 200:
-						if response.status == 401 and response.content_type == "application/json":
-							resp = await response.json()
-							L.warning("Unauthorized access to LLM chat provider", struct_data={"url": self.URL, "response": resp})
-							return None
-						L.warning("Error getting models", struct_data={"status": response.status, "text": await response.text()})
+		try:
+			timeout = aiohttp.ClientTimeout(total=self.TimeoutFirstToken, connect=self.TimeoutConnect)
+			async with self.get_session().get(self.URL + "v1/models", timeout=timeout) as response:
+				# The call also serves as a liveness probe of the provider
+				self.Health.on_probe(response.status < 500)
+
+				if response.status != 200:
+					if response.status == 401 and response.content_type == "application/json":
+						resp = await response.json()
+						L.warning("Unauthorized access to LLM chat provider", struct_data={"url": self.URL, "response": resp})
 						return None
+					L.warning("Error getting models", struct_data={"status": response.status, "text": await response.text()})
+					return None
 
-					resp = await response.json()
-					models = resp['data']
-					if self.URL.startswith('https://api.openai.com/'):
-						# Filter only GPT models from OpenAI API
-						# They offer more models but they are not directly usable for chat.
-						models = filter(lambda model: model['owned_by'] == 'openai', models)
-					self.Models = models
-					return [model['id'] for model in self.Models]
+				resp = await response.json()
+				models = resp['data']
+				if self.URL.startswith('https://api.openai.com/'):
+					# Filter only GPT models from OpenAI API
+					# They offer more models but they are not directly usable for chat.
+					models = [model for model in models if model['owned_by'] == 'openai']
+				self.Models = models
+				return [model['id'] for model in self.Models]
 
-			except aiohttp.ClientError as e:
-				L.warning("Error communicating with LLM: {} {}".format(e.__class__.__name__, e), struct_data={"url": self.URL})
-				return None
+		except (aiohttp.ClientError, TimeoutError) as e:
+			self.Health.on_probe(False)
+			L.warning("Error communicating with LLM: {} {}".format(e.__class__.__name__, e), struct_data={"url": self.URL})
+			return None
 
 		return []
+
+
+def string_to_boolean(value) -> bool:
+	if isinstance(value, bool):
+		return value
+	return str(value).strip().lower() in ('true', 'yes', 'on', '1')
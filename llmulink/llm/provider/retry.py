@@ -0,0 +1,57 @@
+import random
+import datetime
+import email.utils
+
+
+class RetryPolicy:
+	'''
+	Retry policy for requests rejected by a provider with 429 or 503.
+
+	The delay grows exponentially with every retry (with a jitter),
+	but it is never shorter than the `Retry-After` requested by the provider.
+	'''
+
+	def __init__(self, *, max_attempts=3, backoff=1.0, backoff_max=30.0):
+		self.MaxAttempts = max_attempts
+		self.Backoff = backoff
+		self.BackoffMax = backoff_max
+
+
+	def get_delay(self, retry: int, retry_after: str | None = None) -> float | None:
+		'''
+		Get the delay before the retry number `retry` (counted from 0), None if no more retries are allowed.
+		'''
+		if retry + 1 >= self.MaxAttempts:
+			return None
+
+		delay = min(self.BackoffMax, self.Backoff * (2 ** retry))
+		delay = delay / 2 + random.uniform(0, delay / 2)
+
+		requested = parse_retry_after(retry_after)
+		if requested is not None:
+			delay = max(delay, requested)
+
+		return delay
+
+
+def parse_retry_after(value: str | None) -> float | None:
+	'''
+	Parse the `Retry-After` HTTP header, it is either a number of seconds or a HTTP date.
+	'''
+	if value is None:
+		return None
+
+	value = value.strip()
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		pass
+
+	try:
+		date = email.utils.parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return None
+
+	if date.tzinfo is None:
+		date = date.replace(tzinfo=datetime.timezone.utc)
+	return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
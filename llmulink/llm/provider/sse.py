@@ -0,0 +1,121 @@
+'''
+Incremental parser of Server-Sent Events (`text/event-stream`).
+
+https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+'''
+
+
+class SSEEvent:
+
+	__slots__ = ('event', 'data', 'id')
+
+	def __init__(self, event: str, data: bytes, id: str | None):
+		self.event = event  # Event type, 'message' if not given
+		self.data = data  # Data lines joined by '\n', as UTF-8 encoded bytes
+		self.id = id  # Last event id
+
+	def __repr__(self):
+		return "SSEEvent(event={!r}, data={!r}, id={!r})".format(self.event, self.data, self.id)
+
+
+class SSEParser:
+	'''
+	Bytes-level parser of an event stream, fed by chunks of the response body as they arrive.
+	Lines are split out of the chunk at once, they are never decoded to `str`, except `event` and `id` values.
+
+	Lines may be terminated by CRLF, LF or CR and may be split across chunks.
+	Comments and unknown fields are ignored, `id` and `retry` are remembered.
+	An incomplete event at the end of the stream is discarded.
+	'''
+
+	__slots__ = ('Pending', 'SkipLF', 'First', 'EventType', 'EventTypes', 'DataLines', 'LastEventId', 'Retry')
+
+	def __init__(self):
+		self.Pending = b''  # Incomplete line from the previous chunk
+		self.SkipLF = False  # The previous chunk ended by CR, a LF at the start of the next chunk belongs to it
+		self.First = True
+
+		self.EventType = None
+		self.EventTypes = {}  # Decoded event types
+		self.DataLines = []
+		self.LastEventId = None
+		self.Retry = None  # Reconnection time requested by the server, in milliseconds
+
+
+	def feed(self, chunk: bytes) -> list[SSEEvent]:
+		'''
+		Parse the chunk, return events that are complete.
+		'''
+		if self.SkipLF:
+			self.SkipLF = False
+			if chunk.startswith(b'\n'):
+				chunk = chunk[1:]
+
+		data = self.Pending + chunk if len(self.Pending) > 0 else chunk
+
+		if self.First:
+			if len(data) < 3 and b'\xef\xbb\xbf'.startswith(data):
+				# Wait for the complete byte order mark
+				self.Pending = data
+				return []
+			self.First = False
+			if data.startswith(b'\xef\xbb\xbf'):
+				data = data[3:]
+
+		if b'\r' in data:
+			# Normalize line endings to LF, CR at the end may be the first half of CRLF
+			self.SkipLF = data.endswith(b'\r')
+			data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+		lines = data.split(b'\n')
+		self.Pending = lines.pop()
+
+		events = []
+		event_types = self.EventTypes
+		for line in lines:
+			if not line:
+				# Dispatch the event
+				data_lines = self.DataLines
+				if data_lines:
+					self.DataLines = []
+					events.append(SSEEvent(
+						self.EventType or 'message',
+						data_lines[0] if len(data_lines) == 1 else b'\n'.join(data_lines),
+						self.LastEventId,
+					))
+				self.EventType = None
+
+			# The most frequent fields are on the fast path
+			elif line[:6] == b'data: ':
+				self.DataLines.append(line[6:])
+
+			elif line[:7] == b'event: ':
+				# Providers use a few event types, they are decoded once
+				value = line[7:]
+				event_type = event_types.get(value)
+				if event_type is None:
+					event_type = event_types[value] = value.decode('utf-8')
+				self.EventType = event_type
+
+			elif line[0] != 0x3A:  # Lines starting with ':' are comments
+				self._field(line)
+
+		return events
+
+
+	def _field(self, line: bytes) -> None:
+		name, colon, value = line.partition(b':')
+		if colon and value.startswith(b' '):
+			value = value[1:]
+
+		match name:
+			case b'data':
+				self.DataLines.append(value)
+			case b'event':
+				self.EventType = value.decode('utf-8')
+			case b'id':
+				if b'\0' not in value:
+					self.LastEventId = value.decode('utf-8')
+			case b'retry':
+				if value.isdigit():
+					self.Retry = int(value)
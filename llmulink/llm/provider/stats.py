@@ -0,0 +1,112 @@
+import asyncio
+
+
+class ProviderStats:
+	'''
+	Live statistics of a LLM chat provider.
+	The router uses them to select the provider that will answer the fastest.
+
+	Latencies and rates are tracked as exponentially weighted moving averages (EWMA).
+	The value is None until the first sample arrives.
+	'''
+
+	def __init__(self, alpha: float = 0.3):
+		self.Alpha = alpha
+
+		self.InFlight = 0  # Number of requests admitted to a slot of the provider (streaming)
+		self.Queued = 0  # Number of requests in the admission queue that the provider may serve
+		self.TTFT = None  # Time to the first token, in seconds
+		self.TokensPerSecond = None  # Streaming rate after the first token
+		self.Duration = None  # Duration of the whole request, in seconds
+
+
+	@property
+	def load(self) -> int:
+		'''
+		Requests that the provider serves or may have to serve, used to weight its expected latency.
+		'''
+		return self.InFlight + self.Queued
+
+
+	def request(self) -> 'RequestStats':
+		'''
+		Start tracking of a single request to the provider.
+		'''
+		return RequestStats(self)
+
+
+	def _ewma(self, current: float | None, sample: float) -> float:
+		if current is None:
+			return sample
+		return self.Alpha * sample + (1.0 - self.Alpha) * current
+
+
+	def to_dict(self) -> dict:
+		return {
+			"in_flight": self.InFlight,
+			"queued": self.Queued,
+			"ttft": self.TTFT,
+			"tokens_per_second": self.TokensPerSecond,
+			"duration": self.Duration,
+		}
+
+
+class RequestStats:
+	'''
+	Statistics of a single request, folded into the ProviderStats when the request is closed.
+	Times are taken from the clock of the event loop, so that they can be used for deadlines of `asyncio.timeout_at()`.
+	'''
+
+	__slots__ = ('Stats', 'StartedAt', 'FirstTokenAt', 'Tokens', 'Status', 'OnFirstToken')
+
+	def __init__(self, stats: ProviderStats):
+		self.Stats = stats
+		self.StartedAt = asyncio.get_running_loop().time()
+		self.FirstTokenAt = None
+		self.Tokens = 0
+		self.Status = None  # HTTP status of the response
+		self.OnFirstToken = None  # Callback, called at the first token before it is processed
+
+
+	def on_token(self) -> None:
+		'''
+		Called for every streamed event that carries an output of the model.
+		'''
+		if self.FirstTokenAt is None:
+			self.FirstTokenAt = asyncio.get_running_loop().time()
+			if self.OnFirstToken is not None:
+				self.OnFirstToken()
+		self.Tokens += 1
+
+
+	def close(self) -> None:
+		now = asyncio.get_running_loop().time()
+		stats = self.Stats
+		stats.Duration = stats._ewma(stats.Duration, now - self.StartedAt)
+
+		if self.FirstTokenAt is None:
+			# No output has been received, i.e. the request failed
+			self.abandon(now)
+			return
+
+		stats.TTFT = stats._ewma(stats.TTFT, self.FirstTokenAt - self.StartedAt)
+
+		streaming_time = now - self.FirstTokenAt
+		if self.Tokens > 1 and streaming_time > 0:
+			stats.TokensPerSecond = stats._ewma(stats.TokensPerSecond, (self.Tokens - 1) / streaming_time)
+
+
+	def abandon(self, now: float | None = None) -> None:
+		'''
+		Record a request that ended without the first token (cancelled or failed).
+		The elapsed time is a lower bound of the time to the first token,
+		so that a slow or broken provider doesn't keep looking fast just because it never answers.
+		'''
+		if self.FirstTokenAt is not None:
+			return
+		if now is None:
+			now = asyncio.get_running_loop().time()
+		stats = self.Stats
+		elapsed = now - self.StartedAt
+		if stats.TTFT is None or stats.TTFT < elapsed:
+			stats.TTFT = stats._ewma(stats.TTFT, elapsed)
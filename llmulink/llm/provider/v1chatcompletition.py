@@ -1,13 +1,12 @@
-import json
-import asyncio
 import logging
-
-import aiohttp
+import contextlib
 
 import asab
 
 from ..datamodel import Conversation, Exchange, AssistentMessage, AssistentReasoning, FunctionCall
 from .provider_abc import LLMChatProviderABC
+from ..codec import loads, JSONDecodeError
+from .payload import encode_payload, encode_json
 
 L = logging.getLogger(__name__)
 
@@ -20,9 +19,8 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 	'''
 
 	def __init__(self, service, *, url, **kwargs):
-		super().__init__(service, url=url)
+		super().__init__(service, url=url, **kwargs)
 		self.APIKey = kwargs.get('api_key', None)
-		self.Semaphore = asyncio.Semaphore(2)
 
 	def prepare_headers(self):
 		headers = {
@@ -33,107 +31,102 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 		return headers
 
 
-	async def chat_request(self, conversation: Conversation, exchange: Exchange) -> None:
-		messages = []
-
-		# Add system message if instructions are provided
-		if conversation.instructions:
-			messages.append({
-				"role": "system",
-				"content": conversation.instructions,
-			})
-
-		for exch in conversation.exchanges:
-			for item in exch.items:
-				match item.__class__.__name__:
-
-					case "UserMessage":
-						messages.append({
-							"role": "user",
-							"content": item.content,
-						})
-
-					case "AssistentMessage":
-						messages.append({
-							"role": "assistant",
-							"content": item.content,
-						})
-
-					case "AssistentReasoning":
-						# Reasoning is not directly supported in chat completions API
-						# Skip for now
-						pass
-
-					case "FunctionCall":
-						# OpenAI chat completions uses tool_calls format
-						messages.append({
-							"role": "assistant",
-							"content": None,
-							"tool_calls": [{
-								"id": item.call_id,
-								"type": "function",
-								"function": {
-									"name": item.name,
-									"arguments": item.arguments,
-								},
-							}],
-						})
-
-						messages.append({
-							"role": "tool",
-							"tool_call_id": item.call_id,
-							"content": item.content,
-						})
-
-
+	async def chat_request(self, conversation: Conversation, exchange: Exchange, on_first_token=None) -> None:
 		model = conversation.get_model()
 		assert model is not None
 
 		data = {
 			"model": model,
-			"messages": messages,
 			"stream": True,
 		}
 
-		tools = self._build_tools(conversation)
-		if len(tools) > 0:
-			data["tools"] = tools
+		# Add system message if instructions are provided
+		prefix = None
+		if conversation.instructions:
+			prefix = [encode_json({
+				"role": "system",
+				"content": conversation.instructions,
+			})]
+
+		encoded = {
+			"messages": self.encode_history(conversation, prefix),
+		}
+
+		tools = self.encode_tools(conversation)
+		if tools is not None:
+			encoded["tools"] = tools
 
 		L.log(asab.LOG_NOTICE, "Sending request to LLM", struct_data={"conversation_id": conversation.conversation_id, "model": model, "provider": self.URL})
 
-		# State for tracking streaming content
-		self._current_assistant_message = None
-		self._current_tool_calls = {}  # Indexed by tool call index
-
-		async with aiohttp.ClientSession(headers=self.prepare_headers()) as session:
-			async with session.post(self.URL + "v1/chat/completions", json=data, timeout=60*10) as response:
-				if response.status != 200:
-					text = await response.text()
-					L.error(
-						"Error when sending request to LLM chat provider",
-						struct_data={"status": response.status, "text": text}
-					)
-					return
+		await self.send_request(conversation, exchange, encode_payload(data, encoded), on_first_token)
 
-				assert response.content_type == "text/event-stream"
 
-				async for line in response.content:
-					line = line.decode("utf-8").rstrip('\n\r')
+	async def _stream_request(self, conversation: Conversation, exchange: Exchange, payload: bytes, request_stats) -> None:
+		async with self.get_session().post(self.URL + "v1/chat/completions", data=payload) as response:
+			await self.raise_for_status(response, request_stats)
 
-					if line == '':
+			assert response.content_type == "text/event-stream"
+
+			async with contextlib.aclosing(self.read_events(response, request_stats)) as events:
+				async for sse in events:
+					if sse.data == b'[DONE]':
+						# Stream finished, finalize any pending items
+						await self._finalize_stream(conversation, exchange)
+						break
+					try:
+						data = loads(sse.data)
+					except JSONDecodeError as e:
+						L.warning("Invalid JSON in SSE response", struct_data={"data": sse.data.decode("utf-8", "replace"), "error": str(e)})
 						continue
 
-					if line.startswith('data: '):
-						data_str = line[6:]
-						if data_str == '[DONE]':
-							# Stream finished, finalize any pending items
-							await self._finalize_stream(conversation, exchange)
-							break
-						try:
-							data = json.loads(data_str)
-							await self._on_llm_chunk(conversation, exchange, data)
-						except json.JSONDecodeError as e:
-							L.warning("Invalid JSON in SSE response", struct_data={"line": line, "error": str(e)})
+					if len(data.get('choices', [])) > 0:
+						request_stats.on_token()
+					await self._on_llm_chunk(conversation, exchange, data)
+
+
+	def _build_history_item(self, item) -> list[dict]:
+		match item.__class__.__name__:
+
+			case "UserMessage":
+				return [{
+					"role": "user",
+					"content": item.content,
+				}]
+
+			case "AssistentMessage":
+				return [{
+					"role": "assistant",
+					"content": item.content,
+				}]
+
+			case "AssistentReasoning":
+				# Reasoning is not directly supported in chat completions API
+				# Skip for now
+				return []
+
+			case "FunctionCall":
+				# OpenAI chat completions uses tool_calls format
+				return [
+					{
+						"role": "assistant",
+						"content": None,
+						"tool_calls": [{
+							"id": item.call_id,
+							"type": "function",
+							"function": {
+								"name": item.name,
+								"arguments": item.arguments,
+							},
+						}],
+					},
+					{
+						"role": "tool",
+						"tool_call_id": item.call_id,
+						"content": item.content,
+					},
+				]
+
+		return []
 
 
 	async def _on_llm_chunk(self, conversation: Conversation, exchange: Exchange, chunk: dict) -> None:
@@ -173,33 +166,35 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 		# Handle text content delta
 		if 'content' in delta and delta['content'] is not None:
 			text = delta['content']
-			if self._current_assistant_message is None:
+			item = exchange.active_items.get('message')
+			if item is None:
 				# Create new assistant message item
-				self._current_assistant_message = AssistentMessage(
+				item = AssistentMessage(
 					role='assistant',
 					content=text,
 					status='in_progress',
 				)
-				exchange.items.append(self._current_assistant_message)
+				conversation.append_item(exchange, item, index='message')
 				await self.LLMChatService.send_update(conversation, {
 					"type": "item.appended",
-					"item": self._current_assistant_message.to_dict(),
+					"item": item.to_dict(),
 				})
 			else:
 				# Append to existing message
-				self._current_assistant_message.content += text
+				item.append(text)
 				await self.LLMChatService.send_update(conversation, {
 					"type": "item.delta",
-					"key": self._current_assistant_message.key,
+					"key": item.key,
 					"delta": text,
 				})
 
 		# Handle tool calls delta
 		if 'tool_calls' in delta:
 			for tool_call_delta in delta['tool_calls']:
-				index = tool_call_delta.get('index', 0)
+				index = ('tool_call', tool_call_delta.get('index', 0))
 
-				if index not in self._current_tool_calls:
+				item = exchange.active_items.get(index)
+				if item is None:
 					# New tool call
 					tool_call_id = tool_call_delta.get('id', '')
 					function_info = tool_call_delta.get('function', {})
@@ -212,15 +207,13 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 						arguments=arguments,
 						status='in_progress',
 					)
-					self._current_tool_calls[index] = item
-					exchange.items.append(item)
+					conversation.append_item(exchange, item, index=index)
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.appended",
 						"item": item.to_dict(),
 					})
 				else:
 					# Update existing tool call with more arguments
-					item = self._current_tool_calls[index]
 					function_info = tool_call_delta.get('function', {})
 					if 'arguments' in function_info:
 						item.arguments += function_info['arguments']
@@ -229,16 +222,18 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 		if finish_reason is not None:
 			if finish_reason == 'stop':
 				# Normal completion
-				if self._current_assistant_message is not None:
-					self._current_assistant_message.status = 'completed'
+				item = exchange.active_items.pop('message', None)
+				if item is not None:
+					item.status = 'completed'
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.updated",
-						"item": self._current_assistant_message.to_dict(),
+						"item": item.to_dict(),
 					})
 
 			elif finish_reason == 'tool_calls':
 				# Tool calls completion - finalize all tool calls
-				for index, item in self._current_tool_calls.items():
+				for index in [index for index in exchange.active_items if index != 'message']:
+					item = exchange.active_items.pop(index)
 					item.status = 'completed'
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.updated",
@@ -251,28 +246,19 @@ class LLMChatProviderV1ChatCompletition(LLMChatProviderABC):
 		'''
 		Finalize any pending items when the stream ends.
 		'''
-		# Finalize assistant message if still in progress
-		if self._current_assistant_message is not None and self._current_assistant_message.status == 'in_progress':
-			self._current_assistant_message.status = 'completed'
+		active_items = exchange.active_items
+		exchange.active_items = {}
+
+		# The assistant message and tool calls still in progress
+		for item in active_items.values():
+			item.status = 'completed'
 			await self.LLMChatService.send_update(conversation, {
 				"type": "item.updated",
-				"item": self._current_assistant_message.to_dict(),
+				"item": item.to_dict(),
 			})
-
-		# Finalize any tool calls still in progress
-		for index, item in self._current_tool_calls.items():
-			if item.status == 'in_progress':
-				item.status = 'completed'
-				await self.LLMChatService.send_update(conversation, {
-					"type": "item.updated",
-					"item": item.to_dict(),
-				})
+			if isinstance(item, FunctionCall):
 				await self.LLMChatService.create_function_call(conversation, exchange, item)
 
-		# Reset state
-		self._current_assistant_message = None
-		self._current_tool_calls = {}
-
 
 	def _build_tools(self, conversation: Conversation) -> list[dict]:
 		'''
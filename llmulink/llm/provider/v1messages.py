@@ -1,13 +1,12 @@
-import json
-import asyncio
 import logging
-
-import aiohttp
+import contextlib
 
 import asab
 
 from ..datamodel import Conversation, Exchange, AssistentMessage, AssistentReasoning, FunctionCall
-from .provider_abc import LLMChatProviderABC
+from .provider_abc import LLMChatProviderABC, string_to_boolean
+from ..codec import loads, JSONDecodeError
+from .payload import encode_payload, encode_array, encode_json
 
 L = logging.getLogger(__name__)
 
@@ -20,9 +19,17 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 	'''
 
 	def __init__(self, service, *, url, **kwargs):
-		super().__init__(service, url=url)
+		super().__init__(service, url=url, **kwargs)
 		self.APIKey = kwargs.get('api_key', None)
-		self.Semaphore = asyncio.Semaphore(2)
+
+		# Place prompt cache breakpoints (`cache_control`) on the system prompt, tools and the conversation history
+		self.PromptCache = string_to_boolean(kwargs.get('prompt_cache', self.URL.startswith('https://api.anthropic.com')))
+
+		self.TokensCounter = service.MetricsService.create_counter(
+			"llm_provider_tokens",
+			tags={"provider": self.Name},
+			init_values={"input": 0, "output": 0, "cache_read": 0, "cache_write": 0},
+		)
 
 	def prepare_headers(self):
 		headers = {
@@ -37,101 +44,110 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 		return headers
 
 
-	async def chat_request(self, conversation: Conversation, exchange: Exchange) -> None:
-		messages = []
-		for exch in conversation.exchanges:
-			for item in exch.items:
-				match item.__class__.__name__:
-
-					case "UserMessage":
-						messages.append({
-							"role": "user",
-							"content": item.content,
-						})
-
-					case "AssistentMessage":
-						messages.append({
-							"role": "assistant",
-							"content": item.content,
-						})
-
-					case "AssistentReasoning":
-						pass
-
-					case "FunctionCall":
-						# Anthropic uses tool_use/tool_result format
-						messages.append({
-							"role": "assistant",
-							"content": [{
-								"type": "tool_use",
-								"id": item.call_id,
-								"name": item.name,
-								"input": json.loads(item.arguments) if item.arguments else {},
-							}],
-						})
-
-						messages.append({
-							"role": "user",
-							"content": [{
-								"type": "tool_result",
-								"tool_use_id": item.call_id,
-								"content": item.content,
-							}],
-						})
-
-
+	async def chat_request(self, conversation: Conversation, exchange: Exchange, on_first_token=None) -> None:
 		model = conversation.get_model()
 		assert model is not None
 
 		data = {
 			"model": model,
 			"system": conversation.instructions,
-			"messages": messages,
 			"max_tokens": 4096,
 			"stream": True,
 		}
 
-		tools = self._build_tools(conversation)	
-		if len(tools) > 0:
-			data["tools"] = tools
+		fragments = self.get_history_fragments(conversation)
+
+		if self.PromptCache:
+			data["system"] = [{
+				"type": "text",
+				"text": conversation.instructions,
+				"cache_control": CACHE_CONTROL,
+			}]
+
+			# Rolling breakpoint at the end of the history, so that the next turn reads the whole history from the cache
+			if len(fragments) > 0:
+				fragments = fragments[:-1] + [encode_json(_with_cache_control(loads(fragments[-1])))]
+
+		encoded = {
+			"messages": encode_array(fragments),
+		}
+
+		tools = self.encode_tools(conversation)
+		if tools is not None:
+			if self.PromptCache:
+				# The encoded tools are shared with providers that don't cache, the breakpoint is added per request
+				tools = _tools_with_cache_control(tools)
+			encoded["tools"] = tools
 
 		L.log(asab.LOG_NOTICE, "Sending request to LLM", struct_data={"conversation_id": conversation.conversation_id, "model": model, "provider": self.URL})
 
-		async with aiohttp.ClientSession(headers=self.prepare_headers()) as session:
-			async with session.post(self.URL + "v1/messages", json=data) as response:
-				if response.status != 200:
-					text = await response.text()
-					L.error(
-						"Error when sending request to LLM chat provider",
-						struct_data={"status": response.status, "text": text}
-					)
-					return
+		await self.send_request(conversation, exchange, encode_payload(data, encoded), on_first_token)
+
+
+	def _build_history_item(self, item) -> list[dict]:
+		match item.__class__.__name__:
+
+			case "UserMessage":
+				return [{
+					"role": "user",
+					"content": item.content,
+				}]
+
+			case "AssistentMessage":
+				return [{
+					"role": "assistant",
+					"content": item.content,
+				}]
+
+			case "AssistentReasoning":
+				return []
+
+			case "FunctionCall":
+				# Anthropic uses tool_use/tool_result format
+				return [
+					{
+						"role": "assistant",
+						"content": [{
+							"type": "tool_use",
+							"id": item.call_id,
+							"name": item.name,
+							"input": loads(item.arguments) if item.arguments else {},
+						}],
+					},
+					{
+						"role": "user",
+						"content": [{
+							"type": "tool_result",
+							"tool_use_id": item.call_id,
+							"content": item.content,
+						}],
+					},
+				]
 
-				assert response.content_type == "text/event-stream"
+		return []
 
-				# State for tracking content blocks
-				self._current_content_block = None
-				self._current_content_block_index = None
 
-				async for line in response.content:
-					line = line.decode("utf-8").rstrip('\n\r')
-					
-					if line == '':
-						continue
+	async def _stream_request(self, conversation: Conversation, exchange: Exchange, payload: bytes, request_stats) -> None:
+		async with self.get_session().post(self.URL + "v1/messages", data=payload) as response:
+			await self.raise_for_status(response, request_stats)
+
+			assert response.content_type == "text/event-stream"
 
-					if line.startswith('event: '):
-						event_type = line[7:]
+			async with contextlib.aclosing(self.read_events(response, request_stats)) as events:
+				async for sse in events:
+					if sse.data == b'[DONE]':
+						break
+					try:
+						data = loads(sse.data)
+					except JSONDecodeError as e:
+						L.warning("Invalid JSON in SSE response", struct_data={"data": sse.data.decode("utf-8", "replace"), "error": str(e)})
 						continue
 
-					if line.startswith('data: '):
-						data_str = line[6:]
-						if data_str == '[DONE]':
-							break
-						try:
-							data = json.loads(data_str)
-							await self._on_llm_event(conversation, exchange, event_type, data)
-						except json.JSONDecodeError as e:
-							L.warning("Invalid JSON in SSE response", struct_data={"line": line, "error": str(e)})
+					# Servers that omit the `event:` field carry the type in the data
+					event_type = sse.event if sse.event != 'message' else data.get('type', "???")
+					if event_type in ('content_block_start', 'content_block_delta'):
+						request_stats.on_token()
+					await self._on_llm_event(conversation, exchange, event_type, data)
 
 
 	async def _on_llm_event(self, conversation: Conversation, exchange: Exchange, event_type: str, data: dict) -> None:
@@ -149,10 +165,13 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 				#     "model": "claude-3-5-sonnet-20241022",
 				#     "stop_reason": null,
 				#     "stop_sequence": null,
-				#     "usage": {"input_tokens": 25, "output_tokens": 1}
+				#     "usage": {"input_tokens": 25, "output_tokens": 1, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
 				#   }
 				# }
-				pass
+				usage = data.get('message', {}).get('usage') or {}
+				self.TokensCounter.add("input", usage.get('input_tokens') or 0)
+				self.TokensCounter.add("cache_read", usage.get('cache_read_input_tokens') or 0)
+				self.TokensCounter.add("cache_write", usage.get('cache_creation_input_tokens') or 0)
 
 			case 'content_block_start':
 				# {
@@ -172,7 +191,6 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 				#   "index": 0,
 				#   "content_block": {"type": "tool_use", "id": "...", "name": "...", "input": ""}
 				# }
-				self._current_content_block_index = data.get('index')
 				content_block = data.get('content_block', {})
 				block_type = content_block.get('type')
 
@@ -203,8 +221,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 						L.warning("Unknown content block type", struct_data={"type": block_type})
 
 				if item is not None:
-					self._current_content_block = item
-					exchange.items.append(item)
+					conversation.append_item(exchange, item, index=data.get('index'))
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.appended",
 						"item": item.to_dict(),
@@ -231,7 +248,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 				delta = data.get('delta', {})
 				delta_type = delta.get('type')
 
-				item = self._current_content_block
+				item = exchange.active_items.get(data.get('index'))
 				if item is None:
 					L.warning("Received delta without active content block")
 					return
@@ -240,7 +257,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 					case 'text_delta':
 						text = delta.get('text', '')
 						if isinstance(item, AssistentMessage):
-							item.content += text
+							item.append(text)
 							await self.LLMChatService.send_update(conversation, {
 								"type": "item.delta",
 								"key": item.key,
@@ -250,7 +267,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 					case 'thinking_delta':
 						thinking = delta.get('thinking', '')
 						if isinstance(item, AssistentReasoning):
-							item.content += thinking
+							item.append(thinking)
 							await self.LLMChatService.send_update(conversation, {
 								"type": "item.delta",
 								"key": item.key,
@@ -270,7 +287,7 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 				#   "type": "content_block_stop",
 				#   "index": 0
 				# }
-				item = self._current_content_block
+				item = exchange.active_items.pop(data.get('index'), None)
 				if item is not None:
 					item.status = 'completed'
 					await self.LLMChatService.send_update(conversation, {
@@ -281,16 +298,15 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 					if isinstance(item, FunctionCall):
 						await self.LLMChatService.create_function_call(conversation, exchange, item)
 
-				self._current_content_block = None
-				self._current_content_block_index = None
-
 			case 'message_delta':
 				# {
 				#   "type": "message_delta",
 				#   "delta": {"stop_reason": "end_turn", "stop_sequence": null},
 				#   "usage": {"output_tokens": 15}
 				# }
-				pass
+				# The usage is cumulative, input and cache tokens are counted from 'message_start'
+				usage = data.get('usage') or {}
+				self.TokensCounter.add("output", usage.get('output_tokens') or 0)
 
 			case 'message_stop':
 				# {"type": "message_stop"}
@@ -314,10 +330,42 @@ class LLMChatProviderV1Messages(LLMChatProviderABC):
 		https://platform.claude.com/docs/en/api/messages/create
 		'''
 		tools = []
-		for tool in conversation.tools:
+		# Stable order of tools, otherwise the prompt cache would miss
+		for tool in sorted(conversation.tools, key=lambda tool: tool.name):
 			tools.append({
 				"name": tool.name,  # Name of the tool.
 				"description": tool.description,  # Optional, but strongly-recommended description of the tool.
 				"input_schema": tool.parameters,  # JSON schema defining the tool's input arguments.
 			})
+
 		return tools
+
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def _tools_with_cache_control(tools: bytes) -> bytes:
+	'''
+	Mark the last tool of the JSON encoded array of tools as a prompt cache breakpoint.
+	'''
+	assert tools.endswith(b'}]')
+	return tools[:-2] + b',"cache_control":' + encode_json(CACHE_CONTROL) + b'}]'
+
+
+def _with_cache_control(message: dict) -> dict:
+	'''
+	Mark the last content block of the message as a prompt cache breakpoint.
+	'''
+	content = message.get('content')
+	if isinstance(content, str):
+		if len(content) == 0:
+			# Empty text blocks are not allowed
+			return message
+		content = [{"type": "text", "text": content}]
+	elif isinstance(content, list) and len(content) > 0:
+		content = list(content)
+	else:
+		return message
+
+	content[-1] = dict(content[-1], cache_control=CACHE_CONTROL)
+	return dict(message, content=content)
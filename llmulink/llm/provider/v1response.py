@@ -1,13 +1,12 @@
-import json
-import asyncio
 import logging
-
-import aiohttp
+import contextlib
 
 import asab
 
 from ..datamodel import Conversation, Exchange, AssistentMessage, AssistentReasoning, FunctionCall, FunctionCallTool
-from .provider_abc import LLMChatProviderABC
+from .provider_abc import LLMChatProviderABC, LLMProviderError, string_to_boolean
+from ..codec import loads, JSONDecodeError
+from .payload import encode_payload, encode_array, encode_json
 
 L = logging.getLogger(__name__)
 
@@ -19,9 +18,11 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 	'''
 
 	def __init__(self, service, *, url, **kwargs):
-		super().__init__(service, url=url)
+		super().__init__(service, url=url, **kwargs)
 		self.APIKey = kwargs.get('api_key', None)
-		self.Semaphore = asyncio.Semaphore(2)
+
+		# Stateful mode chains responses by `previous_response_id` and sends only new items
+		self.Stateful = string_to_boolean(kwargs.get('stateful', 'no'))
 
 	def prepare_headers(self):
 		headers = {}
@@ -30,107 +31,137 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 		return headers
 
 
-	async def chat_request(self, conversation: Conversation, exchange: Exchange) -> None:
-		inp = []
-		for exch in conversation.exchanges:
-			for item in exch.items:
-				match item.__class__.__name__:
-
-					case "UserMessage" | "AssistentMessage":
-						inp.append({
-							"role": item.role,
-							"content": item.content,
-						})
-
-					case "AssistentReasoning":
-						# Reasoning items are not included in the input
-						pass
-
-					case "FunctionCall":
-						inp.append({
-							"type": "function_call",
-							"call_id": item.call_id,
-							"name": item.name,
-							"arguments": item.arguments,
-						})
-
-						inp.append({
-							"type": "function_call_output",
-							"call_id": item.call_id,
-							"output": item.content,
-						})
-
-
+	async def chat_request(self, conversation: Conversation, exchange: Exchange, on_first_token=None) -> None:
 		model = conversation.get_model()
 		assert model is not None
 
 		data = {
 			"model": model,
 			"instructions": conversation.instructions,
-			"input": inp,
 			"stream": True,  # We expect an SSE response / "text/event-stream"
 		}
 
-		tools = self._build_tools(conversation)	
-		if len(tools) > 0:
-			data["tools"] = tools
+		encoded = {}
+
+		tools = self.encode_tools(conversation)
+		if tools is not None:
+			encoded["tools"] = tools
+
+		if self.Stateful:
+			data["store"] = True
+			previous_response_id, inp = self._encode_new_input(conversation, exchange)
+			if previous_response_id is not None:
+				L.log(asab.LOG_NOTICE, "Sending request to LLM", struct_data={"conversation_id": conversation.conversation_id, "model": model, "provider": self.URL, "previous_response_id": previous_response_id})
+				try:
+					await self.send_request(
+						conversation, exchange,
+						encode_payload(dict(data, previous_response_id=previous_response_id), dict(encoded, input=inp)),
+						on_first_token
+					)
+					return
+				except LLMProviderError as e:
+					if e.Status not in (400, 404) or 'previous_response' not in str(e):
+						raise
+					# The provider has forgotten the response, fall back to the full history
+					L.warning("Previous response not found, resending the full history", struct_data={"conversation_id": conversation.conversation_id, "provider": self.URL})
+
+		encoded["input"] = self.encode_history(conversation)
 		
 		L.log(asab.LOG_NOTICE, "Sending request to LLM", struct_data={"conversation_id": conversation.conversation_id, "model": model, "provider": self.URL})
 
-		async with aiohttp.ClientSession(headers=self.prepare_headers()) as session:
-			async with session.post(self.URL + "v1/responses", json=data) as response:
-				if response.status != 200:
-					text = await response.text()
-					L.error(
-						"Error when sending request to LLM chat provider",
-						struct_data={"status": response.status, "text": text}
-					)
-					return
+		await self.send_request(conversation, exchange, encode_payload(data, encoded), on_first_token)
 
-				assert response.content_type == "text/event-stream"
-				event = []  # Accumulator for the event block in the SSE response
 
-				async for line in response.content:
-					if line == b'\n':
-						if len(event) > 0:
-							# Empty line indicates the end of the event block in the SSE response
-							await self._on_llm_event(conversation, exchange, event)
-							event = []
+	def _encode_new_input(self, conversation: Conversation, exchange: Exchange) -> tuple[str | None, bytes | None]:
+		'''
+		Find the most recent response stored at this provider and encode only the items that follow it.
+		Returns (previous_response_id, input) or (None, None) if there is no such response.
+		'''
+		exchanges = conversation.exchanges
+		for k in range(len(exchanges) - 1, -1, -1):
+			if exchanges[k] is not exchange and exchanges[k].response_id is not None:
+				break
+		else:
+			return None, None
+
+		if exchanges[k].response_provider != self.Name:
+			# The response is stored at another provider
+			return None, None
+
+		entries = []
+
+		# The output of the previous response is known to the provider, except results of function calls
+		for item in exchanges[k].items:
+			if isinstance(item, FunctionCall):
+				entries.append({
+					"type": "function_call_output",
+					"call_id": item.call_id,
+					"output": item.content,
+				})
+
+		for exch in exchanges[k + 1:]:
+			for item in exch.items:
+				entries.extend(self._build_history_item(item))
+
+		return exchanges[k].response_id, encode_array([encode_json(entry) for entry in entries])
+
+
+	def _build_history_item(self, item) -> list[dict]:
+		match item.__class__.__name__:
+
+			case "UserMessage" | "AssistentMessage":
+				return [{
+					"role": item.role,
+					"content": item.content,
+				}]
+
+			case "AssistentReasoning":
+				# Reasoning items are not included in the input
+				return []
+
+			case "FunctionCall":
+				return [
+					{
+						"type": "function_call",
+						"call_id": item.call_id,
+						"name": item.name,
+						"arguments": item.arguments,
+					},
+					{
+						"type": "function_call_output",
+						"call_id": item.call_id,
+						"output": item.content,
+					},
+				]
+
+		return []
+
+
+	async def _stream_request(self, conversation: Conversation, exchange: Exchange, payload: bytes, request_stats) -> None:
+		async with self.get_session().post(self.URL + "v1/responses", data=payload, headers={'Content-Type': 'application/json'}) as response:
+			await self.raise_for_status(response, request_stats)
+
+			assert response.content_type == "text/event-stream"
+
+			async with contextlib.aclosing(self.read_events(response, request_stats)) as events:
+				async for sse in events:
+					try:
+						data = loads(sse.data)
+					except JSONDecodeError as e:
+						L.warning("Invalid JSON in SSE response", struct_data={"data": sse.data.decode("utf-8", "replace"), "error": str(e)})
 						continue
 
-					p = line.find(b': ')
-					if p == -1:
-						L.warning("Invalid line in SSE response")
-						return
-
-					event_type = line[:p].decode("utf-8")					
-					match event_type:
-						case "data":
-							data = json.loads(line[p+2:].decode("utf-8"))
-							event.append(('data', data))
-						case "event":
-							event.append(('event', line[p+2:-1].decode("utf-8")))
-						case _:
-							L.warning("Unknown event type in SSE response", struct_data={"event_type": event_type})
-							event.append(('???', line))
-
-				if len(event) > 0:
+					# Servers that omit the `event:` field carry the type in the data
+					event = {
+						'type': sse.event if sse.event != 'message' else data.get('type', "???"),
+						'data': data,
+					}
+					if event['type'] not in ('response.created', 'response.in_progress'):
+						request_stats.on_token()
 					await self._on_llm_event(conversation, exchange, event)
-					event = []
 
 
-	async def _on_llm_event(self, conversation: Conversation, exchange: Exchange, event_items: list[tuple[str, dict | str | bytes]]) -> None:
-		event = {} 
-		for event_type, event_data in event_items:
-			match event_type:
-				case 'data':
-					event['data'] = event_data
-				case 'event':
-					event['type'] = event_data
-				case _:
-					L.warning("Unknown event item type", struct_data={"event_item_type": event_type})
-					pass
-
+	async def _on_llm_event(self, conversation: Conversation, exchange: Exchange, event: dict) -> None:
 		match event.get('type', "???"):
 
 			case 'response.created':
@@ -214,7 +245,11 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 
 			case 'response.completed':
 				# TODO: Set status to 'done' for the exchange
-				pass
+				# Only completed responses can be continued in the stateful mode
+				# (the id is taken here and not from 'response.created' so that a cancelled hedged request doesn't leave it behind)
+				if self.Stateful:
+					exchange.response_id = event['data']['response']['id']
+					exchange.response_provider = self.Name
 
 
 			case 'response.output_item.added':
@@ -262,7 +297,7 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 						L.warning("Unknown output item type", struct_data={"type": event['data']['item']['type']})
 
 				if item is not None:
-					exchange.items.append(item)
+					conversation.append_item(exchange, item, index=event['data'].get('output_index'))
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.appended",
 						"item": item.to_dict(),
@@ -307,7 +342,7 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 				# print("->>", event['type'], event['data']['output_index'])
 				# pprint.pprint(event['data'], width=2000)
 
-				item = exchange.get_last_item(event['data']['item']['type'])
+				item = exchange.active_items.pop(event['data'].get('output_index'), None)
 				if item is not None:
 					item.status = event['data']['item']['status']  # 'completed'
 					# TODO: Update other fields based on the item type
@@ -357,9 +392,9 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 				# 	'type': 'response.reasoning_text.delta'
 				# }
 
-				item = exchange.get_last_item('reasoning')
-				if item is not None:
-					item.content += event['data']['delta']
+				item = exchange.active_items.get(event['data'].get('output_index'))
+				if isinstance(item, AssistentReasoning):
+					item.append(event['data']['delta'])
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.delta",
 						"key": item.key,
@@ -376,9 +411,9 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 				pass
 				
 			case 'response.output_text.delta':
-				item = exchange.get_last_item('message')
-				if item is not None:
-					item.content += event['data']['delta']
+				item = exchange.active_items.get(event['data'].get('output_index'))
+				if isinstance(item, AssistentMessage):
+					item.append(event['data']['delta'])
 					await self.LLMChatService.send_update(conversation, {
 						"type": "item.delta",
 						"key": item.key,
@@ -407,8 +442,8 @@ class LLMChatProviderV1Response(LLMChatProviderABC):
 				# 	'type': 'response.function_call_arguments.done'
 				# }
 
-				item = exchange.get_last_item('function_call')
-				if item is not None:
+				item = exchange.active_items.get(event['data'].get('output_index'))
+				if isinstance(item, FunctionCall):
 					item_name = event['data'].get('name', None)
 					if item_name is not None:
 						item.name = item_name
@@ -0,0 +1,57 @@
+import itertools
+import collections
+
+from .codec import EncodedEvent
+
+
+class ReplayBuffer:
+	'''
+	Recent events of a conversation, numbered by a per-conversation sequence.
+
+	A client that reconnects tells the sequence number of the last event it has seen
+	and receives only the events it has missed, as long as they are still in the buffer.
+	'''
+
+	__slots__ = ('Events', 'Seq', 'ClearedAt')
+
+	def __init__(self, size: int):
+		self.Events = collections.deque(maxlen=size)
+		self.Seq = 0  # Sequence number of the last event
+		self.ClearedAt = None  # Sequence number at the last clear, earlier states of the conversation can't be caught up
+
+
+	def append(self, event: dict) -> EncodedEvent:
+		'''
+		Number the event and keep it for a replay.
+		'''
+		self.Seq += 1
+		event["seq"] = self.Seq
+		encoded = EncodedEvent(event, self.Seq)
+		self.Events.append(encoded)
+		return encoded
+
+
+	def since(self, seq: int) -> list[EncodedEvent] | None:
+		'''
+		Events that follow the event `seq`.
+		Returns None if some of them are no longer in the buffer (or `seq` is not from this conversation).
+		'''
+		if seq > self.Seq or seq < 0:
+			return None
+		if self.ClearedAt is not None and seq <= self.ClearedAt:
+			return None
+		missing = self.Seq - seq
+		if missing == 0:
+			return []
+		if missing > len(self.Events):
+			return None
+		return list(itertools.islice(self.Events, len(self.Events) - missing, None))
+
+
+	def clear(self) -> None:
+		'''
+		Forget the events (i.e. the history has been rewritten), clients that reconnect get a full update.
+		The sequence continues, so that old sequence numbers are not mistaken for new ones.
+		'''
+		self.Events.clear()
+		self.ClearedAt = self.Seq
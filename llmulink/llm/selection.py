@@ -0,0 +1,86 @@
+import random
+import logging
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+# The length of a "typical" response used to weight the streaming rate against the time to first token
+REFERENCE_TOKENS = 256
+
+
+def base_latency(provider) -> float | None:
+	'''
+	Estimate how long would the idle provider take to answer a typical request, None if there are no statistics yet.
+	'''
+	stats = provider.Stats
+	if stats.TTFT is None:
+		return None
+	latency = stats.TTFT
+	if stats.TokensPerSecond:
+		latency += REFERENCE_TOKENS / stats.TokensPerSecond
+	return latency
+
+
+def prior_latency(providers: list) -> float:
+	'''
+	The latency assumed for providers without statistics: the mean of their peers.
+	An unsampled provider thus competes as an average one, it gets sampled but it is not preferred forever.
+	'''
+	latencies = [latency for latency in map(base_latency, providers) if latency is not None]
+	if len(latencies) == 0:
+		return 0.0
+	return sum(latencies) / len(latencies)
+
+
+def expected_latency(provider, prior: float = 0.0) -> float:
+	'''
+	Estimate how long would the provider take to answer a new request.
+	Providers without statistics are estimated by the `prior` latency.
+	'''
+	latency = base_latency(provider)
+	if latency is None:
+		latency = prior
+	return latency * (provider.Stats.load + 1)
+
+
+def select_random(providers: list):
+	return random.choice(providers)
+
+
+def select_least_in_flight(providers: list):
+	least = min(provider.Stats.load for provider in providers)
+	return random.choice([provider for provider in providers if provider.Stats.load == least])
+
+
+def select_ewma(providers: list):
+	prior = prior_latency(providers)
+	latencies = [expected_latency(provider, prior) for provider in providers]
+	best = min(latencies)
+	return random.choice([provider for provider, latency in zip(providers, latencies) if latency == best])
+
+
+def select_power_of_two_choices(providers: list):
+	if len(providers) < 2:
+		return providers[0]
+	prior = prior_latency(providers)
+	a, b = random.sample(providers, 2)
+	return a if expected_latency(a, prior) <= expected_latency(b, prior) else b
+
+
+SELECTION_STRATEGIES = {
+	"random": select_random,
+	"least_in_flight": select_least_in_flight,
+	"ewma": select_ewma,
+	"p2c": select_power_of_two_choices,
+}
+
+
+def get_selection_strategy(name: str):
+	strategy = SELECTION_STRATEGIES.get(name)
+	if strategy is None:
+		L.warning("Unknown provider selection strategy, using 'random'", struct_data={"strategy": name})
+		strategy = select_random
+	return strategy
@@ -0,0 +1,91 @@
+import time
+import asyncio
+import logging
+
+import asab
+
+#
+
+L = logging.getLogger(__name__)
+
+#
+
+asab.Config.add_defaults({
+	"llm": {
+		# How long is the model catalog considered fresh
+		"models_ttl": "60s",
+	}
+})
+
+
+class LLMModelCatalogService(asab.Service):
+	'''
+	In-memory catalog of models available at LLM chat providers.
+
+	The catalog is refreshed periodically in the background.
+	Stale catalog is served while it is being revalidated and only one refresh is in flight at a time,
+	so that a burst of new WebSocket connections doesn't become a burst of `v1/models` calls.
+	'''
+
+	def __init__(self, app, service_name="LLMModelCatalogService"):
+		super().__init__(app, service_name)
+
+		self.LLMRouterService = app.LLMRouterService
+		self.TTL = asab.Config.getseconds("llm", "models_ttl")
+
+		self.Models = []
+		self.RefreshedAt = None  # Monotonic time of the last refresh
+		self.RefreshTask = None
+
+		app.PubSub.subscribe("Application.tick/10!", self._on_tick)
+
+
+	async def initialize(self, app):
+		# Do not block the application start on slow providers
+		self.refresh()
+
+
+	async def finalize(self, app):
+		if self.RefreshTask is not None:
+			self.RefreshTask.cancel()
+
+
+	async def get_models(self) -> list[str]:
+		'''
+		Get the list of available model ids.
+		The refresh is awaited only if there is nothing to serve yet.
+		'''
+		if self.RefreshedAt is None or len(self.Models) == 0:
+			await asyncio.shield(self.refresh())
+
+		elif self.is_stale():
+			self.refresh()
+
+		return self.Models
+
+
+	def is_stale(self) -> bool:
+		return self.RefreshedAt is None or (time.monotonic() - self.RefreshedAt) >= self.TTL
+
+
+	def refresh(self) -> asyncio.Task:
+		'''
+		Start a refresh of the catalog, unless one is already in flight.
+		'''
+		if self.RefreshTask is None or self.RefreshTask.done():
+			self.RefreshTask = asyncio.create_task(self._refresh(), name="llm-model-catalog-refresh")
+		return self.RefreshTask
+
+
+	async def _refresh(self) -> None:
+		try:
+			self.Models = await self.LLMRouterService.get_models()
+		except Exception:
+			L.exception("Error refreshing the model catalog")
+		finally:
+			self.RefreshedAt = time.monotonic()
+
+
+	async def _on_tick(self, message_type):
+		if self.is_stale():
+			self.refresh()
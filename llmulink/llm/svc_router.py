@@ -1,14 +1,24 @@
 import re
 import uuid
-import random
 import asyncio
+import functools
 import logging
 
 import asab
+import asab.contextvars
 import yaml
 import jinja2
 
 from .datamodel import Conversation, UserMessage, Exchange, FunctionCall, FunctionCallTool
+from .selection import get_selection_strategy
+from .admission import AdmissionQueue, load_priorities
+from .hedging import HedgedChatRequest
+from .context import ContextManager
+from .coalescer import DeltaCoalescer
+from .codec import EncodedEvent
+from .replay import ReplayBuffer
+from .monitor import Monitor
+from .provider.provider_abc import LLMProviderError
 
 from .provider.v1response import LLMChatProviderV1Response
 from .provider.v1messages import LLMChatProviderV1Messages
@@ -20,6 +30,37 @@ L = logging.getLogger(__name__)
 
 #
 
+asab.Config.add_defaults({
+	"llm": {
+		# Strategy for selecting a provider for a model: random, least_in_flight, ewma, p2c
+		"selection": "ewma",
+		# Send the request also to another provider if the first token doesn't arrive in time, 0 disables hedging
+		"hedge_after": "0",
+		"hedge_max": "1",
+		# Token budget of the conversation history, 0 is unbounded; budgets of models are in the [llm:context] section
+		"context_budget": "0",
+		# When the budget is exceeded, reduce the history to this fraction of the budget
+		"context_target": "0.75",
+		# drop_oldest, elide_tool_outputs or summarize
+		"context_policy": "drop_oldest",
+		# Token estimation: bytes, bytes:<bytes per token> or tiktoken:<encoding> (requires tiktoken)
+		"context_tokenizer": "bytes",
+		# Batching of `item.delta` events: flush after the window (in seconds) or when max bytes of text are buffered
+		"delta_window": "0.025",
+		"delta_max_bytes": "1024",
+		# Number of recent events of a conversation kept for clients that reconnect
+		"replay_buffer": "1000",
+		# The full update carries the most recent exchanges up to this number of items, older items are sent in pages on request
+		"page_items": "200",
+		# Outbound queue of each client (in events) and the policy when it overflows: coalesce, snapshot or disconnect
+		"monitor_queue": "1000",
+		"monitor_overflow": "coalesce",
+		# permessage-deflate compression of WebSocket messages, if the client supports it
+		"websocket_compress": "yes",
+	}
+})
+
+
 class LLMRouterService(asab.Service):
 
 
@@ -27,26 +68,102 @@ class LLMRouterService(asab.Service):
 		super().__init__(app, service_name)
 
 		self.LibraryService = app.LibraryService
+		self.MetricsService = app.MetricsService
 
 		self.Providers = []
+		self.ModelIndex = dict[str, list]()  # Routing table: model id -> providers that serve the model
 		self.Conversations = dict[str, Conversation]()
+		self.SelectProvider = get_selection_strategy(asab.Config.get("llm", "selection"))
+		self.HedgeAfter = asab.Config.getseconds("llm", "hedge_after")
+		self.HedgeMax = asab.Config.getint("llm", "hedge_max")
+		self.DeltaWindow = asab.Config.getseconds("llm", "delta_window")
+		self.DeltaMaxBytes = asab.Config.getint("llm", "delta_max_bytes")
+		self.ReplayBufferSize = asab.Config.getint("llm", "replay_buffer")
+		self.PageItems = asab.Config.getint("llm", "page_items")
+		self.MonitorQueueSize = asab.Config.getint("llm", "monitor_queue")
+		self.MonitorOverflow = asab.Config.get("llm", "monitor_overflow")
+		if self.MonitorOverflow not in ('coalesce', 'snapshot', 'disconnect'):
+			raise ValueError("Unknown monitor overflow policy '{}'".format(self.MonitorOverflow))
+		self.MonitorCounter = self.MetricsService.create_counter(
+			"llm_monitor_overflow",
+			init_values={"coalesced": 0, "snapshot": 0, "disconnected": 0},
+		)
+
+		self.ContextManager = ContextManager(self)
 
 		self.load_providers()
 
+		self.AdmissionQueue = AdmissionQueue(self, priorities=load_priorities())
+		for provider in self.Providers:
+			self.AdmissionQueue.register_provider(provider)
+
+		self.HealthAttentions = dict[str, str]()  # Provider name -> id of the "attention required" in ASAB API
+		app.PubSub.subscribe("Application.tick!", self._on_tick)
+
+
+	async def finalize(self, app):
+		for provider in self.Providers:
+			try:
+				await provider.close()
+			except Exception:
+				L.exception("Error closing provider", struct_data={"provider": provider.URL})
+
+
+	def on_provider_health_changed(self, provider) -> None:
+		'''
+		Report unhealthy providers through ASAB API "attention required".
+		'''
+		L.log(asab.LOG_NOTICE, "Provider health changed", struct_data={"provider": provider.Name, "state": provider.Health.State})
+
+		att_id = self.HealthAttentions.pop(provider.Name, None)
+		if att_id is not None:
+			self.App.ASABApiService.remove_attention(att_id)
+
+		if provider.Health.State != 'closed':
+			self.HealthAttentions[provider.Name] = self.App.ASABApiService.attention_required({
+				"name": "llm-provider-unhealthy",
+				"provider": provider.Name,
+				"url": provider.URL,
+				"state": provider.Health.State,
+			})
+
+		# A recovered provider may take requests that wait in the admission queue
+		self.AdmissionQueue.dispatch()
+
+
+	async def _on_tick(self, message_type):
+		for provider in self.Providers:
+			if provider.Health.probe_due():
+				asyncio.create_task(self._probe_provider(provider))
+
+
+	async def _probe_provider(self, provider) -> None:
+		provider.Health.Probing = True
+		try:
+			# The models call reports its outcome to the health of the provider
+			await provider.get_models()
+		except Exception:
+			L.exception("Error probing provider", struct_data={"provider": provider.Name})
+		finally:
+			provider.Health.Probing = False
+
 
 	def load_providers(self):
 		for section in asab.Config.sections():
 			if not section.startswith("provider:"):
 				continue
 
-			ptype = asab.Config[section].get('type')
+			config = dict(asab.Config[section])
+			config.setdefault('name', section[len("provider:"):])
+
+			ptype = config.get('type')
 			match ptype:
 				case 'LLMChatProviderV1Response':
-					self.Providers.append(LLMChatProviderV1Response(self, **asab.Config[section]))
+					self.Providers.append(LLMChatProviderV1Response(self, **config))
 				case 'LLMChatProviderV1Messages':
-					self.Providers.append(LLMChatProviderV1Messages(self, **asab.Config[section]))
+					self.Providers.append(LLMChatProviderV1Messages(self, **config))
 				case 'LLMChatProviderV1ChatCompletition':
-					self.Providers.append(LLMChatProviderV1ChatCompletition(self, **asab.Config[section]))
+					self.Providers.append(LLMChatProviderV1ChatCompletition(self, **config))
 				case _:
 					L.warning("Unknown provider type, skipping", struct_data={"type": ptype})
 
@@ -65,6 +182,7 @@ class LLMRouterService(asab.Service):
 
 		conversation = Conversation(
 			conversation_id=conversation_id,
+			tenant=asab.contextvars.Tenant.get(None),
 			instructions=promt_decl["instructions"],
 			tools=self.App.ToolService.get_tools()
 		)
@@ -80,10 +198,14 @@ class LLMRouterService(asab.Service):
 
 
 	def restart_conversation(self, conversation: Conversation, key: str) -> None:
-		for i in range(len(conversation.exchanges)):
-			if conversation.exchanges[i].items[0].key == key:
-				del conversation.exchanges[i:]
-				return
+		exchange = conversation.get_exchange_of_item(key)
+		if exchange is not None and exchange.items[0].key == key:
+			conversation.truncate(exchange)
+			conversation.payload_cache.clear()
+			conversation.context_window = None
+			if conversation.replay_buffer is not None:
+				conversation.replay_buffer.clear()
+			return
 		L.warning("Conversation restart failed", struct_data={"conversation_id": conversation.conversation_id, "key": key})
 			
 
@@ -95,6 +217,7 @@ class LLMRouterService(asab.Service):
 
 		instructions = promt_decl["instructions"]
 		conversation.instructions = jinja2.Template(instructions).render(params)
+		conversation.payload_cache.clear()
 
 
 	async def get_conversation(self, conversation_id, create=False):
@@ -106,9 +229,9 @@ class LLMRouterService(asab.Service):
 
 	async def create_exchange(self, conversation: Conversation, item: UserMessage) -> None:
 		new_exchange = Exchange()
-		conversation.exchanges.append(new_exchange)
+		conversation.add_exchange(new_exchange)
 
-		new_exchange.items.append(item)
+		conversation.append_item(new_exchange, item)
 		await self.send_update(conversation, {
 			"type": "item.appended",
 			"item": item.to_dict(),
@@ -129,7 +252,7 @@ class LLMRouterService(asab.Service):
 			if len(conversation.tasks) == 0 and not conversation.loop_break:
 				# Initialize a new exchange with LLM
 				new_exchange = Exchange()
-				conversation.exchanges.append(new_exchange)
+				conversation.add_exchange(new_exchange)
 				conversation.loop_break = True
 
 				t = asyncio.create_task(
@@ -162,70 +285,207 @@ class LLMRouterService(asab.Service):
 		assert model is not None, "Model is not set"
 
 		# Find and select a provider for the model
-		providers = [provider for provider in self.Providers if model in set(model['id'] for model in provider.Models)]
-		assert len(providers) > 0, "No provider found for model"
-		provider = random.choice(providers)
+		providers = self.ModelIndex.get(model)
+		if not providers:
+			L.error("No provider found for model", struct_data={"conversation_id": conversation.conversation_id, "model": model})
+			await self.send_update(conversation, {
+				"type": "exchange.error",
+				"error": "No provider found for model '{}'".format(model),
+			})
+			return
 
-		async def print_waiting():
-			while True:
-				await asyncio.sleep(1)
-				# TODO: Indicate waiting for a model in the UI
-				print("Waiting for a model ...")
+		await self.ContextManager.fit(conversation, model, providers)
 
-		waiting_task = asyncio.create_task(print_waiting())
+		request = HedgedChatRequest(
+			self, conversation, exchange, providers,
+			hedge_after=self.HedgeAfter,
+			hedge_max=self.HedgeMax,
+		)
 		try:
-			async with provider.Semaphore:
-				waiting_task.cancel()
-				await provider.chat_request(conversation, exchange)
-		finally:
-			waiting_task.cancel()
+			await request.run()
+		except LLMProviderError as e:
+			L.error(
+				"Chat request failed",
+				struct_data={"conversation_id": conversation.conversation_id, "provider": e.Provider.Name if e.Provider is not None else None, "status": e.Status, "error": str(e)}
+			)
+			await self.send_update(conversation, {
+				"type": "exchange.error",
+				"error": str(e),
+			})
 			
 
-	async def get_models(self):
-		models = []
+	async def get_models(self) -> list[str]:
+		'''
+		Refresh the models from all providers and rebuild the routing table.
+		Returns the list of available model ids.
 
-		async def collect_models(models, provider):
+		A provider that fails to list its models is routed by the models it listed last time,
+		excluding unhealthy providers is up to their circuit breaker.
+		'''
+		async def collect_models(provider):
 			try:
-				pmodels = await provider.get_models()
+				await provider.get_models()
 			except Exception as e:
 				L.exception("Error collecting models", struct_data={"provider": provider.__class__.__name__})
-				return
-
-			if pmodels is not None:
-				models.extend(pmodels)
 
 		async with asyncio.TaskGroup() as tg:
 			for provider in self.Providers:
-				tg.create_task(collect_models(models, provider))
+				tg.create_task(collect_models(provider))
+
+		model_index = dict[str, list]()
+		for provider in self.Providers:
+			for model in provider.Models:
+				model_index.setdefault(model['id'], []).append(provider)
 
-		return models
+		# Swap the routing table at once, so that routing never sees a partially built table
+		self.ModelIndex = model_index
+		return list(model_index.keys())
 
 
 	async def send_update(self, conversation: Conversation, event: dict):
-		async with asyncio.TaskGroup() as tg:
-			for monitor in conversation.monitors:
-				tg.create_task(monitor(event))
+		await self.get_coalescer(conversation).send(event)
+
+
+	def get_coalescer(self, conversation: Conversation) -> DeltaCoalescer:
+		coalescer = conversation.delta_coalescer
+		if coalescer is None:
+			coalescer = conversation.delta_coalescer = DeltaCoalescer(
+				functools.partial(self._send_to_monitors, conversation),
+				window=self.DeltaWindow,
+				max_bytes=self.DeltaMaxBytes,
+			)
+		return coalescer
+
+
+	def get_replay_buffer(self, conversation: Conversation) -> ReplayBuffer:
+		replay_buffer = conversation.replay_buffer
+		if replay_buffer is None:
+			replay_buffer = conversation.replay_buffer = ReplayBuffer(self.ReplayBufferSize)
+		return replay_buffer
+
+
+	async def _send_to_monitors(self, conversation: Conversation, event: dict):
+		# Numbered and encoded once, for all monitors and for a replay
+		event = self.get_replay_buffer(conversation).append(event)
+		# Monitors queue the event, a slow client doesn't hold the others nor the LLM stream
+		for monitor in conversation.monitors:
+			monitor.put(event)
+
+
+	def create_monitor(self, conversation: Conversation, send, close=None) -> Monitor:
+		'''
+		Create a monitor of the conversation that delivers events by the `send` coroutine function.
+		The monitor receives events once it is attached by `attach_monitor()`.
+		'''
+		return Monitor(
+			send,
+			size=self.MonitorQueueSize,
+			policy=self.MonitorOverflow,
+			snapshot=functools.partial(self.build_full_update, conversation),
+			close=close,
+			counter=self.MonitorCounter,
+		)
 
 
-	async def send_full_update(self, conversation: Conversation, monitor):
-		items = []
-		full_update = {
+	async def attach_monitor(self, conversation: Conversation, monitor: Monitor, last_seq: int | None = None) -> None:
+		'''
+		Bring the monitor up to date and start sending events of the conversation to it.
+
+		A monitor that has seen events up to `last_seq` (a client that reconnects) receives only the events it has missed,
+		a full update is sent if there is no `last_seq` or the missed events are no longer in the replay buffer.
+		'''
+		coalescer = self.get_coalescer(conversation)
+		await coalescer.flush()
+
+		# No event can be sent in between, the monitor receives every event exactly once
+		async with coalescer.Lock:
+			events = None
+			if last_seq is not None:
+				events = self.get_replay_buffer(conversation).since(last_seq)
+
+			if events is None:
+				monitor.put(self._build_full_update(conversation))
+			else:
+				L.log(asab.LOG_NOTICE, "Replaying events", struct_data={"conversation_id": conversation.conversation_id, "last_seq": last_seq, "count": len(events)})
+				for event in events:
+					monitor.put(event)
+
+			conversation.monitors.add(monitor)
+
+
+	def detach_monitor(self, conversation: Conversation, monitor: Monitor) -> None:
+		conversation.monitors.discard(monitor)
+		monitor.stop()
+
+
+	async def send_full_update(self, conversation: Conversation, monitor: Monitor):
+		coalescer = self.get_coalescer(conversation)
+		# Buffered deltas are already applied to items in the full update
+		await coalescer.flush()
+		async with coalescer.Lock:
+			monitor.put(self._build_full_update(conversation))
+
+
+	async def build_full_update(self, conversation: Conversation) -> EncodedEvent:
+		coalescer = self.get_coalescer(conversation)
+		await coalescer.flush()
+		async with coalescer.Lock:
+			return self._build_full_update(conversation)
+
+
+	def _build_full_update(self, conversation: Conversation) -> EncodedEvent:
+		seq = self.get_replay_buffer(conversation).Seq
+		cursor, items = self.build_page(conversation, len(conversation.exchanges))
+		return EncodedEvent({
 			"type": "update.full",
 			"conversation_id": conversation.conversation_id,
 			"created_at": conversation.created_at.isoformat(),
+			# Events that follow the full update continue from this sequence number
+			"seq": seq,
 			"items": items,
-		}
-
-		for exchange in conversation.exchanges:
-			for item in exchange.items:
-				match item.__class__:
-					case UserMessage:
-						items.append(item.to_dict())
+			# Older items are requested by `update.page.requested` with this cursor
+			"cursor": cursor,
+			"has_more": cursor > 0,
+		}, seq)
+
+
+	async def send_page(self, conversation: Conversation, monitor: Monitor, cursor: int) -> None:
+		'''
+		Send the page of items that precede the `cursor` (from a full update or a previous page).
+		'''
+		cursor = max(0, min(cursor, len(conversation.exchanges)))
+		start, items = self.build_page(conversation, cursor)
+		monitor.put(EncodedEvent({
+			"type": "update.page",
+			"conversation_id": conversation.conversation_id,
+			"before": cursor,
+			"items": items,
+			"cursor": start,
+			"has_more": start > 0,
+		}))
+
+
+	def build_page(self, conversation: Conversation, end: int) -> tuple[int, list[dict]]:
+		'''
+		Collect items of whole exchanges that precede the exchange `end`, the most recent first, up to `page_items` items.
+		At least one exchange is included, so that a page is never empty while there are older exchanges.
+		Returns the index of the first included exchange (the cursor of the next page) and the items in the conversation order.
+		'''
+		exchanges = conversation.exchanges
+		start = end
+		count = 0
+		while start > 0:
+			size = len(exchanges[start - 1].items)
+			if count > 0 and count + size > self.PageItems:
+				break
+			count += size
+			start -= 1
 
-		try:
-			await monitor(full_update)
-		except Exception:
-			L.exception("Error sending full update to monitors", struct_data={"conversation_id": conversation.conversation_id})
+		items = []
+		for i in range(start, end):
+			for item in exchanges[i].items:
+				items.append(item.to_dict())
+		return start, items
 
 
 	async def create_function_call(self, conversation: Conversation, exchange: Exchange, function_call: FunctionCall):
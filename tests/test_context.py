@@ -0,0 +1,92 @@
+import asyncio
+
+from llmulink.llm import svc_router  # noqa: F401, configuration defaults of the [llm] section
+from llmulink.llm.context import ContextManager, ELIDED_OUTPUT
+from llmulink.llm.datamodel import Conversation, Exchange, UserMessage, AssistentMessage, FunctionCall
+
+
+class MetricsService:
+
+	class Counter:
+		def add(self, name, value):
+			pass
+
+	def create_counter(self, *args, **kwargs):
+		return self.Counter()
+
+
+class Router:
+	MetricsService = MetricsService()
+
+
+def create_manager(policy: str, budget: int) -> ContextManager:
+	manager = ContextManager(Router())
+	manager.Policy = policy
+	manager.DefaultBudget = budget
+	return manager
+
+
+def add_turn(conversation: Conversation, output: str) -> FunctionCall:
+	'''
+	A user message with a function call and the follow-up exchange of the agentic loop, as the router creates them.
+	'''
+	exchange = Exchange()
+	conversation.add_exchange(exchange)
+	conversation.append_item(exchange, UserMessage(role='user', content="Ping the gateway", model="model"))
+	function_call = FunctionCall(call_id="call_1", name="ping", arguments='{"target": "gw"}', status='finished', content=output)
+	conversation.append_item(exchange, function_call)
+
+	conversation.add_exchange(Exchange())
+	return function_call
+
+
+def fit(manager: ContextManager, conversation: Conversation) -> None:
+	asyncio.run(manager.fit(conversation, "model", []))
+
+
+def test_drop_keeps_current_turn():
+	conversation = Conversation(conversation_id="c", instructions="")
+	add_turn(conversation, "x" * 2048)
+
+	manager = create_manager('drop_oldest', 100)
+	fit(manager, conversation)
+	assert conversation.context_window is None or conversation.context_window.Start == 0
+
+
+def test_drop_older_turns():
+	conversation = Conversation(conversation_id="c", instructions="")
+	add_turn(conversation, "x" * 2048)
+	exchange = conversation.exchanges[-1]
+	conversation.append_item(exchange, AssistentMessage(content="The gateway responds.", status='completed', role='assistant'))
+	add_turn(conversation, "y" * 256)
+
+	manager = create_manager('drop_oldest', 200)
+	fit(manager, conversation)
+	# The previous turn is dropped with its agentic loop, the current one is kept
+	assert conversation.context_window.Start == 2
+
+
+def test_elide_keeps_current_turn():
+	conversation = Conversation(conversation_id="c", instructions="")
+	previous = add_turn(conversation, "x" * 2048)
+	current = add_turn(conversation, "y" * 2048)
+
+	manager = create_manager('elide_tool_outputs', 1000)
+	fit(manager, conversation)
+	window = conversation.context_window
+	assert window.get_item(previous).content == ELIDED_OUTPUT
+	assert window.get_item(current).content == current.content
+	assert window.Start == 0
+
+
+def test_elide_never_current_output():
+	conversation = Conversation(conversation_id="c", instructions="")
+	add_turn(conversation, "x" * 2048)
+	current = add_turn(conversation, "y" * 2048)
+
+	# Eliding the previous output is not enough, the previous turn is dropped instead of eliding the current output
+	manager = create_manager('elide_tool_outputs', 700)
+	fit(manager, conversation)
+	window = conversation.context_window
+	assert window.get_item(current).content == current.content
+	assert window.Start == 2
@@ -0,0 +1,101 @@
+import asyncio
+
+from llmulink.llm.codec import EncodedEvent
+from llmulink.llm.monitor import Monitor
+
+
+class SlowClient:
+	'''
+	A conversation with a client that receives an event only when the test lets it.
+	'''
+
+	def __init__(self, size: int, policy: str):
+		self.Seq = 0
+		self.Content = ""
+		self.Received = []
+		self.Sent = asyncio.Semaphore(0)
+		self.SnapshotGate = asyncio.Event()
+		self.SnapshotGate.set()
+		self.Monitor = Monitor(self.send, size=size, policy=policy, snapshot=self.snapshot)
+
+	def delta(self, key: str) -> None:
+		self.Seq += 1
+		text = "{}{} ".format(key, self.Seq)
+		self.Content += text
+		self.Monitor.put(EncodedEvent({"type": "item.delta", "key": key, "delta": text}, self.Seq))
+
+	async def send(self, event: EncodedEvent) -> None:
+		await self.Sent.acquire()
+		self.Received.append(event)
+
+	async def snapshot(self) -> EncodedEvent:
+		await self.SnapshotGate.wait()
+		return EncodedEvent({"type": "update.full", "content": self.Content}, self.Seq)
+
+	async def drain(self) -> None:
+		for _ in range(100):
+			self.Sent.release()
+			await asyncio.sleep(0)
+		self.Monitor.stop()
+
+	def client_content(self) -> str:
+		content = ""
+		for event in self.Received:
+			if event.Event["type"] == "update.full":
+				content = event.Event["content"]
+			elif event.Event["type"] == "item.delta":
+				content += event.Event["delta"]
+		return content
+
+
+def test_coalesce_after_snapshot():
+	async def run():
+		client = SlowClient(size=3, policy='coalesce')
+
+		client.delta("a")
+		await asyncio.sleep(0)  # The writer is sending the first event
+
+		# Deltas of different items can't be merged, the overflow falls back to a snapshot
+		client.SnapshotGate.clear()
+		for key in "baba":
+			client.delta(key)
+		assert client.Monitor.SnapshotPending
+
+		# A delta arrives while the snapshot is built, the snapshot includes it
+		client.Sent.release()
+		await asyncio.sleep(0)
+		client.delta("a")
+		client.SnapshotGate.set()
+		await asyncio.sleep(0)
+
+		# Newer deltas of the same item overflow the queue while the snapshot is sent
+		for key in "aab":
+			client.delta(key)
+
+		await client.drain()
+
+		snapshot = [event for event in client.Received if event.Event["type"] == "update.full"]
+		assert len(snapshot) == 1
+		for event in client.Received[client.Received.index(snapshot[0]) + 1:]:
+			assert event.Seq > snapshot[0].Seq
+		assert client.client_content() == client.Content
+
+	asyncio.run(run())
+
+
+def test_send_failure_closes():
+	async def run():
+		closed = asyncio.Event()
+
+		async def send(event):
+			raise ConnectionResetError("Gone")
+
+		async def close():
+			closed.set()
+
+		monitor = Monitor(send, size=10, policy='coalesce', snapshot=None, close=close)
+		monitor.put(EncodedEvent({"type": "tasks.updated", "count": 1}, 1))
+		await asyncio.wait_for(closed.wait(), 1)
+		assert monitor.Task.done()
+
+	asyncio.run(run())
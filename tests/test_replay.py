@@ -0,0 +1,34 @@
+from llmulink.llm.replay import ReplayBuffer
+
+
+def append(buffer: ReplayBuffer, count: int) -> None:
+	for _ in range(count):
+		buffer.append({"type": "item.delta", "key": "k", "delta": "x"})
+
+
+def test_since():
+	buffer = ReplayBuffer(3)
+	append(buffer, 5)
+	assert buffer.since(5) == []
+	assert [event.Seq for event in buffer.since(3)] == [4, 5]
+	assert [event.Seq for event in buffer.since(2)] == [3, 4, 5]
+	# Evicted from the buffer
+	assert buffer.since(1) is None
+	# Not from this conversation
+	assert buffer.since(6) is None
+	assert buffer.since(-1) is None
+
+
+def test_since_after_clear():
+	buffer = ReplayBuffer(10)
+	append(buffer, 5)
+	buffer.clear()
+
+	# The history has been rewritten, a client from before the clear needs a full update
+	assert buffer.since(5) is None
+	append(buffer, 1)
+	assert buffer.since(5) is None
+	assert buffer.since(3) is None
+	assert [event.Seq for event in buffer.since(6)] == []
+	append(buffer, 1)
+	assert [event.Seq for event in buffer.since(6)] == [7]
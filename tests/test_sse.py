@@ -0,0 +1,93 @@
+from llmulink.llm.provider.sse import SSEParser
+
+
+def parse(*chunks) -> list[tuple]:
+	parser = SSEParser()
+	events = []
+	for chunk in chunks:
+		events.extend(parser.feed(chunk))
+	return [(event.event, event.data, event.id) for event in events]
+
+
+def split_everywhere(stream: bytes) -> list[list[tuple]]:
+	'''
+	Parse the stream split into two chunks at every position.
+	'''
+	return [parse(stream[:i], stream[i:]) for i in range(len(stream) + 1)]
+
+
+def test_single_event():
+	assert parse(b'event: delta\ndata: {"a":1}\n\n') == [('delta', b'{"a":1}', None)]
+
+
+def test_default_event_type():
+	assert parse(b'data: x\n\n') == [('message', b'x', None)]
+
+
+def test_line_endings_across_chunks():
+	expected = [('a', b'1', None), ('message', b'2', None)]
+	for ending in (b'\n', b'\r\n', b'\r'):
+		stream = b'event: a' + ending + b'data: 1' + ending + ending + b'data: 2' + ending + ending
+		for events in split_everywhere(stream):
+			assert events == expected, ending
+
+	# Byte by byte
+	stream = b'data: 1\r\n\r\ndata: 2\r\r'
+	assert parse(*[stream[i:i + 1] for i in range(len(stream))]) == [('message', b'1', None), ('message', b'2', None)]
+
+
+def test_bom_across_chunks():
+	stream = b'\xef\xbb\xbfdata: x\n\n'
+	for events in split_everywhere(stream):
+		assert events == [('message', b'x', None)]
+	assert parse(b'\xef', b'\xbb', b'\xbf', b'data: x\n\n') == [('message', b'x', None)]
+
+	# Only the first BOM is stripped
+	assert parse(b'\xef\xbb\xbf\xef\xbb\xbfdata: x\n\n') == []
+
+
+def test_comments():
+	assert parse(b': keepalive\n\n:\ndata: x\n: comment\n\n') == [('message', b'x', None)]
+
+
+def test_id_and_retry():
+	parser = SSEParser()
+	events = parser.feed(b'id: 7\nretry: 3000\ndata: x\n\ndata: y\n\n')
+	assert [(event.data, event.id) for event in events] == [(b'x', '7'), (b'y', '7')]
+	assert parser.Retry == 3000
+
+	# An id with NUL is ignored, an invalid retry too
+	events = parser.feed(b'id: 8\0\nretry: soon\ndata: z\n\n')
+	assert events[0].id == '7'
+	assert parser.Retry == 3000
+
+	# An empty id resets the last event id
+	events = parser.feed(b'id\ndata: z\n\n')
+	assert events[0].id == ''
+
+
+def test_multiline_data():
+	assert parse(b'data: a\ndata: b\ndata\ndata:c\n\n') == [('message', b'a\nb\n\nc', None)]
+
+
+def test_event_type_reset_after_dispatch():
+	assert parse(b'event: a\ndata: 1\n\ndata: 2\n\n') == [('a', b'1', None), ('message', b'2', None)]
+
+	# An event without data is not dispatched, but its type is reset too
+	assert parse(b'event: a\n\ndata: 2\n\n') == [('message', b'2', None)]
+
+
+def test_field_without_colon():
+	# A bare `data` line is a field with an empty value
+	assert parse(b'data\n\n') == [('message', b'', None)]
+	assert parse(b'event\ndata: x\n\n') == [('message', b'x', None)]
+
+
+def test_value_space():
+	# Only a single leading space is stripped from the value
+	assert parse(b'data:  x\nevent:a\n\n') == [('a', b' x', None)]
+
+
+def test_incomplete_event_discarded():
+	assert parse(b'data: x\n') == []
+	assert parse(b'data: x') == []